@@ -0,0 +1,77 @@
+import sys
+import math
+import time
+from bisect import bisect
+
+from rc.ketama import HashRing, md5_bytes
+
+
+class ListHashRing(object):
+    """The ring before it was backed by arrays: a dict of points and a
+    sorted list, digests are converted byte by byte.
+    """
+
+    def __init__(self, nodes):
+        nodes = set(nodes)
+        self._hashring = {}
+        self._sorted_keys = []
+        for node in nodes:
+            ks = math.floor((40 * len(nodes)) / len(nodes))
+            for i in xrange(0, int(ks)):
+                k = md5_bytes('%s-%s-salt' % (node, i))
+                for l in xrange(0, 4):
+                    key = ((k[3 + l * 4] << 24) | (k[2 + l * 4] << 16) |
+                           (k[1 + l * 4] << 8) | k[l * 4])
+                    self._hashring[key] = node
+                    self._sorted_keys.append(key)
+        self._sorted_keys.sort()
+
+    def get_node(self, key):
+        k = md5_bytes(key)
+        key = (k[3] << 24) | (k[2] << 16) | (k[1] << 8) | k[0]
+        pos = bisect(self._sorted_keys, key)
+        if pos == len(self._sorted_keys):
+            pos = 0
+        return self._hashring[self._sorted_keys[pos]]
+
+
+def timed(func, *args):
+    best = None
+    for _ in xrange(5):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def ring_size(ring):
+    if isinstance(ring, HashRing):
+        return sys.getsizeof(ring._circle[0]) + \
+            sys.getsizeof(ring._circle[1])
+    return sys.getsizeof(ring._hashring) + sys.getsizeof(ring._sorted_keys)
+
+
+def bench_rings():
+    keys = ['user:%s' % i for i in xrange(10000)]
+    print '%-6s %-10s %10s %10s %14s %14s' % (
+        'nodes', 'ring', 'build ms', 'bytes', 'get_node ms', 'get_nodes ms')
+    for node_count in (4, 16, 64, 256):
+        nodes = ['node%s' % i for i in xrange(node_count)]
+        for ring_cls in (ListHashRing, HashRing):
+            build_time = timed(ring_cls, nodes)
+            ring = ring_cls(nodes)
+            get_node_time = timed(lambda: [ring.get_node(k) for k in keys])
+            if hasattr(ring, 'get_nodes'):
+                get_nodes_time = '%14.1f' % (
+                    timed(ring.get_nodes, keys) * 1000)
+            else:
+                get_nodes_time = '%14s' % '-'
+            print '%-6d %-10s %10.1f %10d %14.1f %s' % (
+                node_count, ring_cls.__name__[:10], build_time * 1000,
+                ring_size(ring), get_node_time * 1000, get_nodes_time)
+
+
+if __name__ == '__main__':
+    bench_rings()
@@ -0,0 +1,54 @@
+import time
+import socket
+
+from rc.poller import supported_pollers
+
+
+def bench(func, arg, min_time=0.2):
+    count = 0
+    start = time.time()
+    while 1:
+        for _ in xrange(100):
+            func(arg)
+        count += 100
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+
+def bench_pollers():
+    print '%-6s %-14s %14s %14s' % (
+        'hosts', 'poller', 'per call/s', 'persistent/s')
+    for host_count in (4, 16, 64):
+        pairs = [socket.socketpair() for _ in xrange(host_count)]
+        objects = [(i, pair[0]) for i, pair in enumerate(pairs)]
+        # every socket has a reply waiting, like after a sent request
+        for pair in pairs:
+            pair[1].send('+OK\r\n')
+        for poller_cls in supported_pollers:
+            def per_call(objects):
+                bufs_poll = poller_cls()
+                for key, obj in objects:
+                    bufs_poll.register(key, obj, writable=False)
+                bufs_poll.poll(1.0)
+                bufs_poll.close()
+
+            persistent_poll = poller_cls()
+
+            def persistent(objects):
+                for key, obj in objects:
+                    persistent_poll.register(key, obj, writable=False)
+                persistent_poll.poll(1.0)
+                persistent_poll.clear()
+
+            print '%-6d %-14s %14.0f %14.0f' % (
+                host_count, poller_cls.__name__,
+                bench(per_call, objects), bench(persistent, objects))
+            persistent_poll.close()
+        for pair in pairs:
+            pair[0].close()
+            pair[1].close()
+
+
+if __name__ == '__main__':
+    bench_pollers()
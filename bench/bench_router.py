@@ -0,0 +1,52 @@
+import time
+
+from rc.redis_cluster import RedisCluster
+from rc.redis_router import RedisCRC32HashRouter, RedisConsistentHashRouter, \
+    RedisJumpHashRouter, RedisRendezvousHashRouter
+
+
+routers = [
+    ('crc32', RedisCRC32HashRouter),
+    ('ketama', RedisConsistentHashRouter),
+    ('jump', RedisJumpHashRouter),
+    ('rendezvous', RedisRendezvousHashRouter),
+]
+keys = ['user:%s' % i for i in xrange(20000)]
+
+
+def make_router(router_cls, host_count):
+    hosts = dict((i, {'port': 7000 + i}) for i in xrange(host_count))
+    return RedisCluster(hosts, router_cls=router_cls).router
+
+
+def bench_routers():
+    print '%-6s %-11s %10s %12s %10s %10s' % (
+        'hosts', 'router', 'build ms', 'keys/s', 'max/mean', 'moved')
+    for host_count in (4, 16, 64):
+        for router_name, router_cls in routers:
+            start = time.time()
+            router = make_router(router_cls, host_count)
+            build_time = time.time() - start
+
+            start = time.time()
+            host_keys = router.get_hosts_for_keys(keys)
+            keys_per_second = len(keys) / (time.time() - start)
+
+            mean = len(keys) / float(host_count)
+            balance = max(len(k) for k in host_keys.values()) / mean
+
+            before = dict((key, host_name)
+                          for host_name, host_keys_ in host_keys.iteritems()
+                          for key in host_keys_)
+            resized = make_router(router_cls, host_count + 1)
+            moved = sum(1 for host_name, host_keys_ in
+                        resized.get_hosts_for_keys(keys).iteritems()
+                        for key in host_keys_ if before[key] != host_name)
+
+            print '%-6d %-11s %10.1f %12.0f %10.3f %9.1f%%' % (
+                host_count, router_name, build_time * 1000, keys_per_second,
+                balance, 100.0 * moved / len(keys))
+
+
+if __name__ == '__main__':
+    bench_routers()
@@ -0,0 +1,60 @@
+import time
+
+from rc.serializer import JSONSerializer, PickleSerializer, \
+    MsgpackSerializer, MarshalSerializer, msgpack
+
+
+post = {
+    'id': 12345,
+    'title': u'A post about caching',
+    'content': u'Lorem ipsum dolor sit amet, consectetur adipiscing '
+               u'elit. ' * 20,
+    'tags': [u'redis', u'cache', u'python'],
+    'created_ts': 1466000000,
+    'updated_ts': 1466100000,
+    'score': 4.5,
+    'published': True,
+}
+payloads = [
+    ('small int', 42),
+    ('id list', range(1000)),
+    ('post', post),
+    ('post list', [dict(post, id=i) for i in range(100)]),
+]
+serializers = [
+    ('json', JSONSerializer()),
+    ('pickle 0', PickleSerializer()),
+    ('pickle 2', PickleSerializer(2)),
+    ('marshal', MarshalSerializer()),
+]
+if msgpack is not None:
+    serializers.append(('msgpack', MsgpackSerializer()))
+
+
+def bench(func, arg, min_time=0.2):
+    count = 0
+    start = time.time()
+    while 1:
+        for _ in xrange(100):
+            func(arg)
+        count += 100
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+
+def bench_serializers():
+    print '%-10s %-10s %12s %12s %10s' % (
+        'payload', 'serializer', 'dumps/s', 'loads/s', 'size')
+    for payload_name, payload in payloads:
+        for serializer_name, serializer in serializers:
+            string = serializer.dumps(payload)
+            print '%-10s %-10s %12.0f %12.0f %10d' % (
+                payload_name, serializer_name,
+                bench(serializer.dumps, payload),
+                bench(serializer.loads, string),
+                len(string))
+
+
+if __name__ == '__main__':
+    bench_serializers()
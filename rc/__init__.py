@@ -10,9 +10,14 @@
 """
 from rc.cache import Cache, CacheCluster
 from rc.serializer import BaseSerializer, JSONSerializer, PickleSerializer
+from rc.serializer import MsgpackSerializer, MarshalSerializer
 from rc.redis_router import BaseRedisRouter, RedisCRC32HashRouter
-from rc.redis_router import RedisConsistentHashRouter
+from rc.redis_router import RedisConsistentHashRouter, RedisJumpHashRouter
+from rc.redis_router import RedisRendezvousHashRouter, RedisClusterSlotRouter
 from rc.testing import NullCache, FakeRedisCache
+from rc.local_cache import LocalCache
+from rc.compressor import BaseCompressor, ZlibCompressor, LZ4Compressor
+from rc.compressor import ZstdCompressor
 
 
 __version__ = '0.3.1'
@@ -22,8 +27,15 @@ __all__ = [
     'Cache', 'CacheCluster',
 
     'BaseSerializer', 'JSONSerializer', 'PickleSerializer',
+    'MsgpackSerializer', 'MarshalSerializer',
 
     'BaseRedisRouter', 'RedisCRC32HashRouter', 'RedisConsistentHashRouter',
+    'RedisJumpHashRouter', 'RedisRendezvousHashRouter',
+    'RedisClusterSlotRouter',
 
     'NullCache', 'FakeRedisCache',
+
+    'LocalCache',
+
+    'BaseCompressor', 'ZlibCompressor', 'LZ4Compressor', 'ZstdCompressor',
 ]
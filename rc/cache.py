@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
+import time
+import math
+import uuid
+import random
 import inspect
+import threading
 import functools
 from itertools import izip
+from multiprocessing.pool import ThreadPool
 
 from rc.redis_clients import RedisClient
 from rc.redis_cluster import RedisCluster
 from rc.serializer import JSONSerializer
-from rc.utils import generate_key_for_cached_func
+from rc.utils import generate_key_for_cached_func, pack_meta, unpack_meta
+from rc.utils import add_hash_tag, make_arg_getter
 from rc.promise import Promise
+from rc.concurrency import SingleFlight, WorkerPool
+from rc.compressor import decompress
 
 
 #: Running mode for cache
@@ -15,6 +24,33 @@ NORMAL_MODE = 0
 BATCH_MODE = 1
 
 
+#: Marker for missing values of the local cache
+_missing = object()
+
+
+#: How often we check for the value while another process holds the lock
+LOCK_POLL_INTERVAL = 0.05
+
+
+#: Deletes a lock key only if it still holds our token, the lock may have
+#: expired and been taken by another process
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _ttl_to_expire(ttl):
+    """Converts a ``PTTL`` reply to seconds, `None` if the key is missing or
+    does not expire.
+    """
+    if ttl is None or ttl < 0:
+        return
+    return ttl / 1000.0
+
+
 class cached_property(object):
 
     def __init__(self, fget):
@@ -34,21 +70,47 @@ class BaseCache(object):
                            expire specified on :meth:`~rc.cache.BaseCache.set`.
     :param bypass_values: a list of return values that would be ignored by the
                           cache decorator and won't be cached at all.
+    :param local_cache: a :class:`~rc.local_cache.LocalCache` that is checked
+                        before redis, it keeps deserialized values in this
+                        process.
+    :param refresh_workers: maximum number of threads that refresh stale
+                            results of cache decorated functions in the
+                            background.
+    :param batch_workers: number of threads that call cache decorated
+                          functions for missing results in batch mode, by
+                          default they are called one by one.
+    :param compressor_cls: the compression class you want to use, by default
+                           values are neither compressed nor decompressed.
+    :param compressor_options: a dictionary of parameters that is useful for
+                               setting other parameters of compressor.
 
     .. versionadded:: 0.3
         The `bypass_values` parameter was added.
+
+    .. versionadded:: 0.4
+        The `local_cache`, `refresh_workers`, `batch_workers`,
+        `compressor_cls` and `compressor_options` parameters were added.
     """
 
     def __init__(self, namespace=None, serializer_cls=None,
-                 default_expire=3 * 24 * 3600, bypass_values=[]):
+                 default_expire=3 * 24 * 3600, bypass_values=[],
+                 local_cache=None, refresh_workers=4, batch_workers=1,
+                 compressor_cls=None, compressor_options=None):
+        if compressor_options is None:
+            compressor_options = {}
         if serializer_cls is None:
             serializer_cls = JSONSerializer
         self.namespace = namespace or ''
         self.serializer_cls = serializer_cls
         self.default_expire = default_expire
         self.bypass_values = bypass_values
-        self._running_mode = NORMAL_MODE
-        self._pending_operations = []
+        self.local_cache = local_cache
+        self.refresh_workers = refresh_workers
+        self.batch_workers = batch_workers
+        self.compressor_cls = compressor_cls
+        self.compressor_options = compressor_options
+        self._batch_state = threading.local()
+        self._single_flight = SingleFlight()
 
     def get_client(self):
         """Returns the redis client that is used for cache."""
@@ -59,11 +121,59 @@ class BaseCache(object):
         """Returns the redis client that is used for cache."""
         return self.get_client()
 
+    @property
+    def _batch_stack(self):
+        """The batches of the current thread, innermost last.  Each batch
+        is a list of pending operations, `None` means the cache decorated
+        functions are called as usual until it is popped.
+        """
+        try:
+            return self._batch_state.stack
+        except AttributeError:
+            stack = self._batch_state.stack = []
+            return stack
+
+    @property
+    def _running_mode(self):
+        stack = self._batch_stack
+        if stack and stack[-1] is not None:
+            return BATCH_MODE
+        return NORMAL_MODE
+
     @cached_property
     def serializer(self):
         """Returns the serializer instance that is used for cache."""
         return self.serializer_cls()
 
+    @cached_property
+    def compressor(self):
+        """Returns the compressor instance that is used for cache, `None`
+        is returned if values are not compressed.
+        """
+        if self.compressor_cls is None:
+            return
+        return self.compressor_cls(**self.compressor_options)
+
+    def _compress(self, string):
+        if self.compressor is None:
+            return string
+        return self.compressor.compress(string)
+
+    def _decompress(self, string):
+        # without a compressor strings are read as they are, custom
+        # serializers may write the markers of the compressors
+        if self.compressor is None:
+            return string
+        return decompress(string, self.compressor)
+
+    @cached_property
+    def _refresh_pool(self):
+        return WorkerPool(self.refresh_workers)
+
+    @cached_property
+    def _batch_pool(self):
+        return ThreadPool(self.batch_workers)
+
     def _raw_get(self, key):
         return self.client.get(self.namespace + key)
 
@@ -79,12 +189,95 @@ class BaseCache(object):
             keys = [self.namespace + key for key in keys]
         return self.client.mget(keys)
 
+    def _pipeline(self):
+        """Returns a pipeline of the client, `None` is returned if the
+        client does not support pipelines.
+        """
+        pipeline = getattr(self.client, 'pipeline', None)
+        if pipeline is None:
+            return
+        return pipeline()
+
+    def _raw_set_many(self, mapping, expire=None):
+        pipe = self._pipeline()
+        if pipe is None:
+            rv = True
+            for key, string in mapping.iteritems():
+                if not self._raw_set(key, string, expire):
+                    rv = False
+            return rv
+        if expire is None:
+            expire = self.default_expire
+        for key, string in mapping.iteritems():
+            pipe.setex(self.namespace + key, expire, string)
+        return all(pipe.execute())
+
+    def _raw_add(self, key, string, expire):
+        return self.client.set(self.namespace + key, string,
+                               px=int(expire * 1000), nx=True)
+
+    def _raw_release_lock(self, key, token):
+        return self.client.eval(RELEASE_LOCK_SCRIPT, 1, self.namespace + key,
+                                token)
+
+    def _raw_get_with_ttl(self, key):
+        """Returns the string of a key and how many seconds it still lives,
+        see :meth:`_raw_ttl_many`.
+        """
+        pipe = self._pipeline()
+        if pipe is None:
+            return self._raw_get(key), None
+        key = self.namespace + key
+        string, ttl = pipe.get(key).pttl(key).execute()
+        return string, _ttl_to_expire(ttl)
+
+    def _raw_ttl_many(self, *keys):
+        """Returns how many seconds the keys still live, `None` for keys
+        that are missing or do not expire and for clients without pipelines.
+        """
+        pipe = self._pipeline()
+        if pipe is None or not keys:
+            return [None] * len(keys)
+        for key in keys:
+            pipe.pttl(self.namespace + key)
+        return map(_ttl_to_expire, pipe.execute())
+
+    def _local_get(self, key):
+        if self.local_cache is None:
+            return _missing
+        return self.local_cache.get(self.namespace + key, _missing)
+
+    def _local_set(self, key, value, string, expire=None, fresh_until=None):
+        if self.local_cache is None or string is None:
+            return
+        if expire is None:
+            expire = self.default_expire
+        if fresh_until is not None:
+            # local hits never recompute, so results that can be recomputed
+            # are only kept until they can be due
+            expire = min(expire, fresh_until - time.time())
+        self.local_cache.set(self.namespace + key, value, len(string), expire)
+
+    def _local_delete(self, *keys):
+        if self.local_cache is not None:
+            self.local_cache.delete_many([self.namespace + key
+                                          for key in keys])
+
     def get(self, key):
         """Returns the value for the cache key, otherwise `None` is returned.
 
         :param key: cache key
         """
-        return self.serializer.loads(self._raw_get(key))
+        value = self._local_get(key)
+        if value is not _missing:
+            return value
+        if self.local_cache is None:
+            return self.serializer.loads(self._decompress(self._raw_get(key)))
+        # the local value must not outlive the key in redis
+        string, expire = self._raw_get_with_ttl(key)
+        value = self.serializer.loads(self._decompress(string))
+        self._local_set(key, value, string, expire)
+        return value
 
     def set(self, key, value, expire=None):
         """Adds or overwrites key/value to the cache.   The value expires in
@@ -95,7 +288,9 @@ class BaseCache(object):
         :param expire: expiration time
         :return: Whether the key has been set
         """
-        return self._raw_set(key, self.serializer.dumps(value), expire)
+        self._local_delete(key)
+        return self._raw_set(key, self._compress(self.serializer.dumps(value)),
+                             expire)
 
     def delete(self, key):
         """Deletes the value for the cache key.
@@ -103,11 +298,27 @@ class BaseCache(object):
         :param key: cache key
         :return: Whether the key has been deleted
         """
+        self._local_delete(key)
         return self.client.delete(self.namespace + key)
 
     def get_many(self, *keys):
         """Returns the a list of values for the cache keys."""
-        return [self.serializer.loads(s) for s in self._raw_get_many(*keys)]
+        if self.local_cache is None:
+            return self.serializer.loads_many(
+                map(self._decompress, self._raw_get_many(*keys)))
+        rv = [self._local_get(key) for key in keys]
+        missing_keys = [key for key, value in izip(keys, rv)
+                        if value is _missing]
+        strings = self._raw_get_many(*missing_keys)
+        values = iter(self.serializer.loads_many(
+            map(self._decompress, strings)))
+        expires = iter(self._raw_ttl_many(*missing_keys))
+        strings = iter(strings)
+        for i, key in enumerate(keys):
+            if rv[i] is _missing:
+                rv[i] = next(values)
+                self._local_set(key, rv[i], next(strings), next(expires))
+        return rv
 
     def set_many(self, mapping, expire=None):
         """Sets multiple keys and values using dictionary.
@@ -119,11 +330,11 @@ class BaseCache(object):
         """
         if not mapping:
             return True
-        rv = True
-        for key, value in mapping.iteritems():
-            if not self.set(key, value, expire):
-                rv = False
-        return rv
+        self._local_delete(*mapping)
+        keys = mapping.keys()
+        strings = self.serializer.dumps_many([mapping[key] for key in keys])
+        string_mapping = dict(izip(keys, map(self._compress, strings)))
+        return self._raw_set_many(string_mapping, expire)
 
     def delete_many(self, *keys):
         """Deletes multiple keys.
@@ -132,9 +343,138 @@ class BaseCache(object):
         """
         if not keys:
             return True
-        return all(self.delete(key) for key in keys)
+        pipe = self._pipeline()
+        if pipe is None:
+            return all(self.delete(key) for key in keys)
+        self._local_delete(*keys)
+        for key in keys:
+            pipe.delete(self.namespace + key)
+        return all(pipe.execute())
 
-    def cache(self, key_prefix=None, expire=None, include_self=False):
+    def _unpack(self, string, recompute_beta=None):
+        """Strips the recomputation metadata from a cached string, returns
+        the serialized result, whether it should be recomputed and the time
+        until which it is fresh, see :meth:`_get_fresh_until`.
+        """
+        string, delta, expiry = unpack_meta(string)
+        string = self._decompress(string)
+        if delta is None:
+            return string, False, None
+        now = time.time()
+        fresh_until = self._get_fresh_until(delta, expiry, recompute_beta)
+        if recompute_beta is not None:
+            # XFetch: recompute with a probability that grows as expiry nears
+            now -= delta * recompute_beta * math.log(1.0 - random.random())
+        return string, now >= expiry, fresh_until
+
+    def _get_fresh_until(self, delta, expiry, recompute_beta):
+        """Returns the time until which a result is not due, for early
+        recomputation this is where the recomputation window starts.
+        """
+        if recompute_beta is None:
+            return expiry
+        return expiry - delta * recompute_beta
+
+    def _make_value(self, f, args, kwargs, params):
+        """Calls the cache decorated function, returns the serialized result
+        and the string that should be cached, which is `None` if the result
+        is bypassed.
+        """
+        start = time.time()
+        value = f(*args, **kwargs)
+        rv = self.serializer.dumps(value)
+        if value in self.bypass_values:
+            return rv, None
+        string = self._compress(rv)
+        recompute_after = params['recompute_after']
+        if recompute_after is None:
+            return rv, string
+        now = time.time()
+        return rv, pack_meta(string, now - start, now + recompute_after)
+
+    def _compute_value(self, f, args, kwargs, cache_key, params):
+        """Calls the cache decorated function and sets the result, returns
+        the serialized result and whether it is cached.
+        """
+        rv, string = self._make_value(f, args, kwargs, params)
+        if string is None:
+            return rv, False
+        self._raw_set(cache_key, string, params['expire'])
+        return rv, True
+
+    def _compute_missing_value(self, f, args, kwargs, cache_key, params):
+        """Like :meth:`_compute_value` but returns the result if another
+        thread or process has cached it in the meantime.
+        """
+        rv, due = self._unpack(self._raw_get(cache_key),
+                               params['recompute_beta'])[:2]
+        if rv is not None and not due:
+            return rv, True
+        return self._compute_value(f, args, kwargs, cache_key, params)
+
+    def _compute_value_with_lock(self, stale, f, args, kwargs, cache_key,
+                                 params):
+        lock_timeout = params['lock_timeout']
+        lock_key = cache_key + u':lock'
+        token = uuid.uuid4().hex
+        if not self._raw_add(lock_key, token, lock_timeout):
+            if stale is not None:
+                return stale, True
+            deadline = time.time() + lock_timeout
+            while time.time() < deadline:
+                time.sleep(LOCK_POLL_INTERVAL)
+                rv = self._unpack(self._raw_get(cache_key))[0]
+                if rv is not None:
+                    return rv, True
+            return self._compute_value(f, args, kwargs, cache_key, params)
+        try:
+            return self._compute_missing_value(f, args, kwargs, cache_key,
+                                               params)
+        finally:
+            self._raw_release_lock(lock_key, token)
+
+    def _recompute(self, stale, f, args, kwargs, cache_key, params):
+        if params['lock_timeout'] is not None:
+            return self._single_flight.do(
+                cache_key, self._compute_value_with_lock,
+                stale, f, args, kwargs, cache_key, params)
+        if params['single_flight']:
+            return self._single_flight.do(
+                cache_key, self._compute_missing_value,
+                f, args, kwargs, cache_key, params)
+        return self._compute_value(f, args, kwargs, cache_key, params)
+
+    def _refresh(self, stale, f, args, kwargs, cache_key, params):
+        self._recompute(stale, f, args, kwargs, cache_key, params)
+        self._local_delete(cache_key)
+
+    def _resolve(self, rv, due, fresh_until, f, args, kwargs, cache_key,
+                 params):
+        """Returns the result for a serialized result that is fetched from
+        redis, it recomputes the result if it is missing or due.
+        """
+        if rv is not None and due and params['soft_expire'] is not None:
+            self._refresh_pool.submit(cache_key, self._refresh, rv,
+                                      f, args, kwargs, cache_key, params)
+            return self.serializer.loads(rv)
+        if rv is None or due:
+            start = time.time()
+            rv, cached = self._recompute(rv, f, args, kwargs, cache_key,
+                                         params)
+            if not cached:
+                return self.serializer.loads(rv)
+            if params['recompute_after'] is not None:
+                now = time.time()
+                fresh_until = self._get_fresh_until(
+                    now - start, now + params['recompute_after'],
+                    params['recompute_beta'])
+        value = self.serializer.loads(rv)
+        self._local_set(cache_key, value, rv, params['expire'], fresh_until)
+        return value
+
+    def cache(self, key_prefix=None, expire=None, include_self=False,
+              single_flight=False, lock_timeout=None, early_recompute=False,
+              beta=1.0, soft_expire=None, hash_tag=None):
         """A decorator that is used to cache a function with supplied
         parameters.  It is intended for decorator usage::
 
@@ -155,6 +495,31 @@ class BaseCache(object):
         :param expire: expiration time
         :param include_self: whether to include the `self` or `cls` as
                              cache key for method or not, default to be False
+        :param single_flight: if the result is missing, only one caller in
+                              this process calls the function, the others
+                              wait for its result
+        :param lock_timeout: if set, the function is called only once across
+                             all processes using a lock key in redis, other
+                             processes wait for the result for at most this
+                             many seconds before calling the function by
+                             themselves.  This implies `single_flight`.
+        :param early_recompute: whether to recompute the result before it
+                                expires, with a probability that grows as
+                                expiration nears.  The time it took to
+                                compute the result is stored with it.
+        :param beta: used with `early_recompute`, values larger than 1.0
+                     favor earlier recomputation
+        :param soft_expire: if set, the result is stale after this many
+                            seconds, a stale result is returned right away
+                            and recomputed in the background.  `expire` is
+                            still the time after which the result is gone.
+        :param hash_tag: puts a hash tag in front of the cache key, so
+                         related results go to the same host of a cache
+                         cluster whose router has `hash_tags` enabled.  It
+                         is the index of the positional argument that is the
+                         tag, not counting `self` or `cls`, the argument may
+                         also be passed by keyword, or a function that is
+                         called with the arguments and returns the tag.
 
         .. note::
 
@@ -181,13 +546,42 @@ class BaseCache(object):
 
         .. versionadded:: 0.2
             The `include_self` parameter was added.
+
+        .. versionadded:: 0.4
+            The `single_flight`, `lock_timeout`, `early_recompute`, `beta`,
+            `soft_expire` and `hash_tag` parameters were added.
         """
+        if soft_expire is not None:
+            recompute_after = soft_expire
+        elif early_recompute:
+            recompute_after = self.default_expire if expire is None \
+                else expire
+        else:
+            recompute_after = None
+        params = {
+            'key_prefix': key_prefix,
+            'expire': expire,
+            'include_self': include_self,
+            'single_flight': single_flight,
+            'lock_timeout': lock_timeout,
+            'recompute_beta': beta if early_recompute else None,
+            'recompute_after': recompute_after,
+            'soft_expire': soft_expire,
+            'many': False,
+            'hash_tag': hash_tag,
+        }
+
         def decorator(f):
             argspec = inspect.getargspec(f)
             if argspec and argspec[0] and argspec[0][0] in ('self', 'cls'):
                 has_self = True
             else:
                 has_self = False
+            if hash_tag is not None and not callable(hash_tag):
+                # finds the tag also if it is passed as keyword argument
+                tag_func = make_arg_getter(f, hash_tag, has_self)
+            else:
+                tag_func = hash_tag
 
             @functools.wraps(f)
             def wrapper(*args, **kwargs):
@@ -198,24 +592,119 @@ class BaseCache(object):
                         cache_args = args[1:]
                 cache_key = generate_key_for_cached_func(
                     key_prefix, f, *cache_args, **kwargs)
+                if tag_func is not None:
+                    cache_key = add_hash_tag(cache_key, tag_func,
+                                             args[1:] if has_self else args,
+                                             kwargs)
                 if self._running_mode == BATCH_MODE:
                     promise = Promise()
-                    self._pending_operations.append(
-                        (f, args, kwargs, promise, cache_key, expire))
+                    self._batch_stack[-1].append(
+                        (f, args, kwargs, promise, cache_key, params))
                     return promise
-                rv = self._raw_get(cache_key)
-                if rv is None:
-                    value = f(*args, **kwargs)
-                    rv = self.serializer.dumps(value)
-                    if value not in self.bypass_values:
-                        self._raw_set(cache_key, rv, expire)
-                return self.serializer.loads(rv)
+                value = self._local_get(cache_key)
+                if value is not _missing:
+                    return value
+                rv, due, fresh_until = self._unpack(
+                    self._raw_get(cache_key), params['recompute_beta'])
+                return self._resolve(rv, due, fresh_until, f, args, kwargs,
+                                     cache_key, params)
+
+            wrapper.__rc_cache_params__ = dict(params, hash_tag=tag_func)
+            return wrapper
+        return decorator
 
-            wrapper.__rc_cache_params__ = {
-                'key_prefix': key_prefix,
-                'expire': expire,
-                'include_self': include_self,
-            }
+    def cache_many(self, key_prefix=None, expire=None, include_self=False,
+                   hash_tag=None):
+        """A decorator that is used to cache a function that loads many
+        results at once.  The function is called with a list of ids as the
+        last positional argument and returns a dictionary that maps ids to
+        results.  The decorated function returns such a dictionary as well,
+        every result is cached on its own and the function is only called
+        with the ids of missing results::
+
+            @cache.cache_many()
+            def load_posts(post_ids):
+                posts = Post.query.filter(Post.id.in_(post_ids))
+                return dict((post.id, post.to_dict()) for post in posts)
+
+            rv = load_posts([1, 2, 3])
+            rv = load_posts([2, 3, 4]) # only post 4 is loaded
+
+        The cache key of every result is the same as if you decorated one
+        function that loads one result with :meth:`cache`, so you can
+        invalidate it with the id::
+
+            cache.invalidate(load_posts, 2)
+
+        On batch mode, the decorated function returns a
+        :class:`~rc.promise.Promise` object that resolves to the dictionary,
+        and all missing ids of all calls are loaded with one function call.
+        Ids missing from the returned dictionary are cached as `None`.
+
+        :param key_prefix: this is used to ensure cache result won't clash
+                           with another function that has the same name
+                           in this module
+        :param expire: expiration time
+        :param include_self: whether to include the `self` or `cls` as
+                             cache key for method or not, default to be False
+        :param hash_tag: same as the `hash_tag` of :meth:`cache`, every id is
+                         the last positional argument of its result
+
+        .. versionadded:: 0.4
+        """
+        params = {
+            'key_prefix': key_prefix,
+            'expire': expire,
+            'include_self': include_self,
+            'single_flight': False,
+            'lock_timeout': None,
+            'recompute_beta': None,
+            'recompute_after': None,
+            'soft_expire': None,
+            'many': True,
+            'hash_tag': hash_tag,
+        }
+
+        def decorator(f):
+            argspec = inspect.getargspec(f)
+            if argspec and argspec[0] and argspec[0][0] in ('self', 'cls'):
+                has_self = True
+            else:
+                has_self = False
+            if hash_tag is not None and not callable(hash_tag):
+                # finds the tag also if it is passed as keyword argument
+                tag_func = make_arg_getter(f, hash_tag, has_self)
+            else:
+                tag_func = hash_tag
+
+            @functools.wraps(f)
+            def wrapper(*args):
+                args, ids = args[:-1], list(args[-1])
+                cache_args = args
+                # handle self and cls
+                if has_self:
+                    if not include_self:
+                        cache_args = args[1:]
+                operations = []
+                for id in ids:
+                    cache_key = generate_key_for_cached_func(
+                        key_prefix, f, *(cache_args + (id,)))
+                    if tag_func is not None:
+                        tag_args = args[1:] if has_self else args
+                        cache_key = add_hash_tag(cache_key, tag_func,
+                                                 tag_args + (id,), {})
+                    operations.append(
+                        (f, args + (id,), {}, Promise(), cache_key, params))
+                promise = Promise()
+                Promise.all([operation[3] for operation in operations]).then(
+                    lambda values: promise.resolve(dict(izip(ids, values))))
+                if self._running_mode == BATCH_MODE:
+                    self._batch_stack[-1].extend(operations)
+                    return promise
+                self._execute_operations(operations)
+                return promise.value
+
+            wrapper.__rc_cache_params__ = dict(params, hash_tag=tag_func)
             return wrapper
         return decorator
 
@@ -252,6 +741,8 @@ class BaseCache(object):
                 cache_args = tuple([instance_self] + list(args))
         cache_key = generate_key_for_cached_func(
             key_prefix, func, *cache_args, **kwargs)
+        cache_key = add_hash_tag(cache_key, cache_params.get('hash_tag'),
+                                 args, kwargs)
         return self.delete(cache_key)
 
     def batch_mode(self):
@@ -267,32 +758,150 @@ class BaseCache(object):
                     results.append(get_result(i))
             results = map(lambda r: r.value, results)
 
-        .. note::
-
-            When you are using rc on this mode, rc is not thread safe.
+        Batch mode is local to the current thread, so one cache object can
+        be shared by the threads of a threaded server.  Batches can be
+        nested, the promises of the inner batch are resolved when the inner
+        batch ends.
         """
         return BatchManager(self)
 
     def batch(self, cancel=False):
         if self._running_mode != BATCH_MODE:
             raise RuntimeError('You have to batch on batch mode.')
-        pending_operations = self._pending_operations
-        self._pending_operations = []
-        self._running_mode = NORMAL_MODE
+        stack = self._batch_stack
+        pending_operations = stack.pop()
         if cancel:
             return
+        # cache decorated functions called by the functions we evaluate
+        # run as usual, even if there is an outer batch
+        stack.append(None)
+        try:
+            self._execute_operations(pending_operations)
+        finally:
+            stack.pop()
+
+    def _execute_operations(self, operations):
+        """Fetches the results of cache decorated function calls with one
+        multi key command and resolves their promises.
+        """
+        remote_operations = []
+        for operation in operations:
+            value = self._local_get(operation[4])
+            if value is _missing:
+                remote_operations.append(operation)
+            else:
+                operation[3].resolve(value)
         cache_keys = []
-        for f, args, kwargs, promise, cache_key, expire in pending_operations:
-            cache_keys.append(cache_key)
+        for operation in remote_operations:
+            cache_keys.append(operation[4])
         cache_results = self._raw_get_many(*cache_keys)
-        for rv, (func, args, kwargs, promise, cache_key, expire) in izip(
-                cache_results, pending_operations):
-            if rv is None:
-                value = func(*args, **kwargs)
-                rv = self.serializer.dumps(value)
-                if value not in self.bypass_values:
-                    self._raw_set(cache_key, rv, expire)
-            promise.resolve(self.serializer.loads(rv))
+        found_operations = []
+        found_strings = []
+        found_fresh_untils = []
+        missing_operations = []
+        for string, operation in izip(cache_results, remote_operations):
+            func, args, kwargs, promise, cache_key, params = operation
+            rv, due, fresh_until = self._unpack(string,
+                                                params['recompute_beta'])
+            if rv is not None and not due:
+                found_operations.append(operation)
+                found_strings.append(rv)
+                found_fresh_untils.append(fresh_until)
+            elif (rv is None or params['soft_expire'] is None) and \
+                    not params['single_flight'] and \
+                    params['lock_timeout'] is None:
+                missing_operations.append(operation)
+            else:
+                promise.resolve(self._resolve(rv, due, fresh_until, func,
+                                              args, kwargs, cache_key,
+                                              params))
+        values = self.serializer.loads_many(found_strings)
+        for value, rv, fresh_until, operation in izip(
+                values, found_strings, found_fresh_untils, found_operations):
+            self._local_set(operation[4], value, rv, operation[5]['expire'],
+                            fresh_until)
+            operation[3].resolve(value)
+        if missing_operations:
+            self._batch_compute(missing_operations)
+
+    def _make_many_values(self, operations):
+        """Calls a function decorated by :meth:`cache_many` once for all
+        operations, returns a list of what :meth:`_make_value` returns.
+        """
+        func, args = operations[0][0], operations[0][1]
+        ids = [operation[1][-1] for operation in operations]
+        results = func(*(args[:-1] + (ids,)))
+        values = [results.get(id) for id in ids]
+        rv = []
+        for value, string in izip(values,
+                                  self.serializer.dumps_many(values)):
+            if value in self.bypass_values:
+                rv.append((string, None))
+            else:
+                rv.append((string, self._compress(string)))
+        return rv
+
+    def _batch_compute(self, operations):
+        """Computes the results of pending operations and sets them with
+        one multi key command for every expiration time.
+        """
+        operations_by_key = {}
+        jobs = []
+        many_jobs = {}
+        for operation in operations:
+            cache_key = operation[4]
+            if cache_key in operations_by_key:
+                operations_by_key[cache_key].append(operation)
+                continue
+            operations_by_key[cache_key] = [operation]
+            if operation[5]['many']:
+                # the other arguments can be unhashable like the ids, so
+                # they are grouped by their string like cache keys are
+                group = (operation[0], generate_key_for_cached_func(
+                    None, operation[0], *operation[1][:-1]))
+                if group not in many_jobs:
+                    many_jobs[group] = []
+                    jobs.append(many_jobs[group])
+                many_jobs[group].append(operation)
+            else:
+                jobs.append([operation])
+
+        def run(job):
+            if job[0][5]['many']:
+                return self._make_many_values(job)
+            func, args, kwargs, promise, cache_key, params = job[0]
+            return [self._make_value(func, args, kwargs, params)]
+        if self.batch_workers > 1 and len(jobs) > 1:
+            job_values = self._batch_pool.map(run, jobs)
+        else:
+            job_values = map(run, jobs)
+        unique_operations = []
+        values = []
+        for job, job_value in izip(jobs, job_values):
+            unique_operations.extend(job)
+            values.extend(job_value)
+
+        mappings = {}
+        for (rv, string), operation in izip(values, unique_operations):
+            if string is not None:
+                expire = operation[5]['expire']
+                mappings.setdefault(expire, {})[operation[4]] = string
+        for expire, mapping in mappings.iteritems():
+            self._raw_set_many(mapping, expire)
+        loaded_values = self.serializer.loads_many([rv for rv, _ in values])
+        for (rv, string), value, operation in izip(values, loaded_values,
+                                                   unique_operations):
+            cache_key, params = operation[4], operation[5]
+            if string is not None:
+                _, delta, expiry = unpack_meta(string)
+                fresh_until = None
+                if delta is not None:
+                    fresh_until = self._get_fresh_until(
+                        delta, expiry, params['recompute_beta'])
+                self._local_set(cache_key, value, rv, params['expire'],
+                                fresh_until)
+            for same_key_operation in operations_by_key[cache_key]:
+                same_key_operation[3].resolve(value)
 
 
 class Cache(BaseCache):
@@ -313,17 +922,34 @@ class Cache(BaseCache):
                           setting other parameters to the StrictRedis client.
     :param bypass_values: a list of return values that would be ignored by the
                           cache decorator and won't be cached at all.
+    :param local_cache: a :class:`~rc.local_cache.LocalCache` that is checked
+                        before redis.
+    :param refresh_workers: maximum number of threads that refresh stale
+                            results in the background.
+    :param batch_workers: number of threads that call cache decorated
+                          functions for missing results in batch mode.
+    :param compressor_cls: the compression class you want to use, by default
+                           values are neither compressed nor decompressed.
+    :param compressor_options: a dictionary of parameters that is useful for
+                               setting other parameters of compressor.
 
     .. versionadded:: 0.3
         The `bypass_values` parameter was added.
+
+    .. versionadded:: 0.4
+        The `local_cache`, `refresh_workers`, `batch_workers`,
+        `compressor_cls` and `compressor_options` parameters were added.
     """
 
     def __init__(self, host='localhost', port=6379, db=0, password=None,
                  socket_timeout=None, namespace=None, serializer_cls=None,
                  default_expire=3 * 24 * 3600, redis_options=None,
-                 bypass_values=[]):
+                 bypass_values=[], local_cache=None, refresh_workers=4,
+                 batch_workers=1, compressor_cls=None,
+                 compressor_options=None):
         BaseCache.__init__(self, namespace, serializer_cls, default_expire,
-                           bypass_values)
+                           bypass_values, local_cache, refresh_workers,
+                           batch_workers, compressor_cls, compressor_options)
         if redis_options is None:
             redis_options = {}
         self.host = host
@@ -339,20 +965,10 @@ class Cache(BaseCache):
                            socket_timeout=self.socket_timeout,
                            **self.redis_options)
 
-    def set_many(self, mapping, expire=None):
-        if not mapping:
-            return True
-        if expire is None:
-            expire = self.default_expire
-        pipe = self.client.pipeline()
-        for key, value in mapping.iteritems():
-            string = self.serializer.dumps(value)
-            pipe.setex(self.namespace + key, expire, string)
-        return all(pipe.execute())
-
     def delete_many(self, *keys):
         if not keys:
             return True
+        self._local_delete(*keys)
         if self.namespace:
             keys = [self.namespace + key for key in keys]
         return self.client.delete(*keys)
@@ -394,17 +1010,46 @@ class CacheCluster(BaseCache):
                            (select/poll/kqueue/epoll).
     :param bypass_values: a list of return values that would be ignored by the
                           cache decorator and won't be cached at all.
+    :param local_cache: a :class:`~rc.local_cache.LocalCache` that is checked
+                        before redis.
+    :param refresh_workers: maximum number of threads that refresh stale
+                            results in the background.
+    :param batch_workers: number of threads that call cache decorated
+                          functions for missing results in batch mode.
+    :param compressor_cls: the compression class you want to use, by default
+                           values are neither compressed nor decompressed.
+    :param compressor_options: a dictionary of parameters that is useful for
+                               setting other parameters of compressor.
+    :param max_concurrency_per_server: defines how many parallel queries can
+                                       happen at the same time on one redis
+                                       server, hosts that share a server
+                                       count together.  By default only
+                                       `max_concurrency` applies.
+    :param max_keys_per_command: multi key operations send at most this many
+                                 keys with one command to one host, more keys
+                                 are split into several pipelined commands.
+                                 By default there is no limit.
 
     .. versionadded:: 0.3
         The `bypass_values` parameter was added.
+
+    .. versionadded:: 0.4
+        The `local_cache`, `refresh_workers`, `batch_workers`,
+        `compressor_cls`, `compressor_options`,
+        `max_concurrency_per_server` and `max_keys_per_command` parameters
+        were added.
     """
 
     def __init__(self, hosts, namespace=None, serializer_cls=None,
                  default_expire=3 * 24 * 3600, router_cls=None,
                  router_options=None, pool_cls=None, pool_options=None,
-                 max_concurrency=64, poller_timeout=1.0, bypass_values=[]):
+                 max_concurrency=64, poller_timeout=1.0, bypass_values=[],
+                 local_cache=None, refresh_workers=4, batch_workers=1,
+                 compressor_cls=None, compressor_options=None,
+                 max_concurrency_per_server=None, max_keys_per_command=None):
         BaseCache.__init__(self, namespace, serializer_cls, default_expire,
-                           bypass_values)
+                           bypass_values, local_cache, refresh_workers,
+                           batch_workers, compressor_cls, compressor_options)
         self.hosts = hosts
         self.router_cls = router_cls
         self.router_options = router_options
@@ -412,6 +1057,8 @@ class CacheCluster(BaseCache):
         self.pool_options = pool_options
         self.max_concurrency = max_concurrency
         self.poller_timeout = poller_timeout
+        self.max_concurrency_per_server = max_concurrency_per_server
+        self.max_keys_per_command = max_keys_per_command
 
     def get_client(self):
         redis_cluster = RedisCluster(self.hosts, router_cls=self.router_cls,
@@ -419,22 +1066,22 @@ class CacheCluster(BaseCache):
                                      pool_cls=self.pool_cls,
                                      pool_options=self.pool_options)
         return redis_cluster.get_client(self.max_concurrency,
-                                        self.poller_timeout)
+                                        self.poller_timeout,
+                                        self.max_concurrency_per_server,
+                                        self.max_keys_per_command)
 
-    def set_many(self, mapping, expire=None):
-        if not mapping:
-            return True
+    def _raw_set_many(self, mapping, expire=None):
         if expire is None:
             expire = self.default_expire
-        string_mapping = {}
-        for key, value in mapping.iteritems():
-            string = self.serializer.dumps(value)
-            string_mapping[self.namespace + key] = string
-        return self.client.msetex(string_mapping, expire)
+        if self.namespace:
+            mapping = dict((self.namespace + key, string)
+                           for key, string in mapping.iteritems())
+        return self.client.msetex(mapping, expire)
 
     def delete_many(self, *keys):
         if not keys:
             return True
+        self._local_delete(*keys)
         if self.namespace:
             keys = [self.namespace + key for key in keys]
         return self.client.mdelete(*keys)
@@ -447,7 +1094,7 @@ class BatchManager(object):
         self.cache = cache
 
     def __enter__(self):
-        self.cache._running_mode = BATCH_MODE
+        self.cache._batch_stack.append([])
         return self.cache
 
     def __exit__(self, exc_type, exc_value, tb):
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import zlib
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+
+class BaseCompressor(object):
+    """Baseclass for compressor.  Subclass this to get your own compressor.
+    Compressed strings start with a one byte header, :attr:`marker`, so
+    compressed and uncompressed strings can be read at the same time.
+    Strings that are shorter than `min_length`, or that do not get smaller,
+    are not compressed.
+
+    :param min_length: strings shorter than this are not compressed
+    """
+    is_supported = False
+
+    #: the one byte header of compressed strings, it must never be the first
+    #: byte of a serialized string
+    marker = None
+
+    def __init__(self, min_length=1024):
+        self.min_length = min_length
+
+    def compress_data(self, data):
+        """Compresses data."""
+        raise NotImplementedError()
+
+    def decompress_data(self, data):
+        """Decompresses data."""
+        raise NotImplementedError()
+
+    def compress(self, string):
+        """Compresses a serialized string if it is worth it."""
+        if len(string) < self.min_length:
+            return string
+        data = self.compress_data(string)
+        if len(data) + 1 >= len(string):
+            return string
+        return self.marker + data
+
+    def decompress(self, string):
+        """Decompresses a string that is compressed by this compressor."""
+        return self.decompress_data(string[1:])
+
+
+class ZlibCompressor(BaseCompressor):
+    """One compressor that uses zlib
+
+    :param min_length: strings shorter than this are not compressed
+    :param level: compression level from 1 to 9
+    """
+    is_supported = True
+    marker = '\xf1'
+
+    def __init__(self, min_length=1024, level=6):
+        BaseCompressor.__init__(self, min_length)
+        self.level = level
+
+    def compress_data(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress_data(self, data):
+        return zlib.decompress(data)
+
+
+class LZ4Compressor(BaseCompressor):
+    """One compressor that uses lz4, it depends on the `lz4`_ library.
+
+    .. _lz4: https://github.com/python-lz4/python-lz4
+
+    :param min_length: strings shorter than this are not compressed
+    """
+    is_supported = lz4 is not None
+    marker = '\xf2'
+
+    def compress_data(self, data):
+        return lz4.compress(data)
+
+    def decompress_data(self, data):
+        return lz4.decompress(data)
+
+
+class ZstdCompressor(BaseCompressor):
+    """One compressor that uses zstd, it depends on the `zstandard`_
+    library.
+
+    .. _zstandard: https://github.com/indygreg/python-zstandard
+
+    :param min_length: strings shorter than this are not compressed
+    :param level: compression level
+    """
+    is_supported = zstd is not None
+    marker = '\xf3'
+
+    def __init__(self, min_length=1024, level=3):
+        BaseCompressor.__init__(self, min_length)
+        self.level = level
+
+    def compress_data(self, data):
+        # zstd contexts are not thread safe, so we do not share them
+        return zstd.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress_data(self, data):
+        return zstd.ZstdDecompressor().decompress(data)
+
+
+supported_compressors = [compressor for compressor in [ZlibCompressor,
+                                                       LZ4Compressor,
+                                                       ZstdCompressor]
+                         if compressor.is_supported]
+_decompressors = dict((compressor.marker, compressor())
+                      for compressor in supported_compressors)
+
+
+def decompress(string, compressor=None):
+    """Decompresses a string that is compressed by any supported compressor,
+    other strings are returned as they are.  If `compressor` is given, the
+    strings with its marker are decompressed with it, so subclasses of
+    :class:`BaseCompressor` can be read too.
+    """
+    # one byte strings are never compressed, msgpack uses some of the
+    # markers for small negative integers
+    if not string or len(string) < 2:
+        return string
+    if compressor is not None and string[0] == compressor.marker:
+        return compressor.decompress(string)
+    decompressor = _decompressors.get(string[0])
+    if decompressor is None:
+        return string
+    return decompressor.decompress(string)
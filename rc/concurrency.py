@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import Queue
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Makes sure only one call for a certain key is running at the same
+    time in this process.  Callers that come while the call is running wait
+    for it and get the same result, or the same exception.  Example::
+
+        flight = SingleFlight()
+        rv = flight.do('key', load_from_database, 'key')
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Calls `func` with the arguments unless there is already one
+        call running for `key`, returns the result of the call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                is_leader = True
+            else:
+                is_leader = False
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.value
+
+
+class WorkerPool(object):
+    """A bounded pool of daemon threads that runs jobs in the background.
+    At most `max_workers` threads are started, lazily, and at most
+    `max_pending` jobs are queued, new jobs are dropped once the queue is
+    full.  Jobs have a key, a job is dropped as well if there is already a
+    pending job with the same key.  Example::
+
+        pool = WorkerPool(max_workers=4)
+        pool.submit('key', refresh, 'key')
+
+    :param max_workers: maximum number of threads
+    :param max_pending: maximum number of queued jobs
+    """
+
+    def __init__(self, max_workers=4, max_pending=1024):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._queue = Queue.Queue(max_pending)
+        self._pending_keys = set()
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queues one job, returns whether it is queued."""
+        with self._lock:
+            if key in self._pending_keys:
+                return False
+            try:
+                self._queue.put_nowait((key, func, args, kwargs))
+            except Queue.Full:
+                return False
+            self._pending_keys.add(key)
+            if len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        return True
+
+    def join(self):
+        """Blocks until all queued jobs are done."""
+        self._queue.join()
+
+    def _work(self):
+        while 1:
+            key, func, args, kwargs = self._queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('Background job for %r failed', key)
+            finally:
+                with self._lock:
+                    self._pending_keys.discard(key)
+                self._queue.task_done()
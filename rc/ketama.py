@@ -1,64 +1,176 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import math
+import struct
+import threading
+from array import array
+from bisect import bisect, bisect_left
 
-from bisect import bisect
+
+#: Typecode of the unsigned 32 bit integers of the ring points
+POINT_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+
+_digest_points_struct = struct.Struct('<4I')
+_key_point_struct = struct.Struct('<I')
 
 
 def md5_bytes(key):
     return map(ord, hashlib.md5(key).digest())
 
 
+def md5_points(key):
+    """Returns the four little endian 32 bit integers of the md5 digest of
+    a key, every one is a point on the ring.
+    """
+    return _digest_points_struct.unpack(hashlib.md5(key).digest())
+
+
 class HashRing(object):
+    """A ketama consistent hash ring.  The points of the ring are kept in
+    a sorted array, and a parallel array holds the index of the node
+    for each point.
+
+    Nodes can be added and removed with :meth:`add_node` and
+    :meth:`remove_node`, only the points that change are touched.  Lookups
+    can run on other threads at the same time.
+
+    :param nodes: the nodes of the ring
+    :param weights: a dictionary that maps nodes to their weights, the
+                    default weight is 1
+    """
 
     def __init__(self, nodes=None, weights=None):
         self._nodes = set(nodes or [])
-        self._weights = weights if weights else {}
+        self._weights = dict(weights) if weights else {}
+        self._lock = threading.Lock()
 
         self._rebuild_circle()
 
-    def _rebuild_circle(self):
-        self._hashring = {}
-        self._sorted_keys = []
+    def _get_point_counts(self):
+        """Returns a dictionary that maps nodes to their number of md5
+        digests on the ring, every digest gives four points.
+        """
         total_weight = 0
         for node in self._nodes:
             total_weight += self._weights.get(node, 1)
 
+        rv = {}
         for node in self._nodes:
             weight = self._weights.get(node, 1)
+            rv[node] = int(math.floor(
+                (40 * len(self._nodes) * weight) / total_weight))
+        return rv
 
-            ks = math.floor((40 * len(self._nodes) * weight) / total_weight)
-
-            for i in xrange(0, int(ks)):
-                k = md5_bytes('%s-%s-salt' % (node, i))
-
-                for l in xrange(0, 4):
-                    key = ((k[3 + l * 4] << 24) | (k[2 + l * 4] << 16) |
-                           (k[1 + l * 4] << 8) | k[l * 4])
-                    self._hashring[key] = node
-                    self._sorted_keys.append(key)
-
-        self._sorted_keys.sort()
+    def _rebuild_circle(self):
+        nodes = list(self._nodes)
+        point_counts = self._get_point_counts()
+
+        point_to_index = {}
+        for index, node in enumerate(nodes):
+            for i in xrange(0, point_counts[node]):
+                for point in md5_points('%s-%s-salt' % (node, i)):
+                    point_to_index[point] = index
+
+        points = sorted(point_to_index)
+        self._node_indexes = dict((node, index)
+                                  for index, node in enumerate(nodes))
+        #: the sorted points, the node index of every point and the nodes,
+        #: they are replaced together so lookups never see a half update
+        self._circle = (array(POINT_TYPECODE, points),
+                        array(POINT_TYPECODE,
+                              [point_to_index[p] for p in points]),
+                        nodes)
+
+    def add_node(self, node, weight=None):
+        """Adds a node to the ring, or changes the weight of a node.  With
+        equal weights the other nodes keep their points, otherwise their
+        points are added or removed as their share changes.
+        """
+        with self._lock:
+            point_counts = self._get_point_counts()
+            self._nodes.add(node)
+            if weight is not None:
+                self._weights[node] = weight
+            self._update_circle(point_counts)
+
+    def remove_node(self, node):
+        """Removes a node from the ring, its keys move to the next points
+        on the ring.
+        """
+        with self._lock:
+            if node not in self._nodes:
+                return
+            point_counts = self._get_point_counts()
+            self._nodes.discard(node)
+            self._weights.pop(node, None)
+            self._update_circle(point_counts)
+
+    def _update_circle(self, old_point_counts):
+        new_point_counts = self._get_point_counts()
+        points, point_nodes, nodes = self._circle
+        points = array(POINT_TYPECODE, points)
+        point_nodes = array(POINT_TYPECODE, point_nodes)
+        nodes = list(nodes)
+
+        for node in set(old_point_counts) | set(new_point_counts):
+            old_count = old_point_counts.get(node, 0)
+            new_count = new_point_counts.get(node, 0)
+            if new_count > old_count:
+                index = self._node_indexes.get(node)
+                if index is None:
+                    index = self._node_indexes[node] = len(nodes)
+                    nodes.append(node)
+                for i in xrange(old_count, new_count):
+                    for point in md5_points('%s-%s-salt' % (node, i)):
+                        pos = bisect_left(points, point)
+                        if pos < len(points) and points[pos] == point:
+                            point_nodes[pos] = index
+                        else:
+                            points.insert(pos, point)
+                            point_nodes.insert(pos, index)
+            elif new_count < old_count:
+                index = self._node_indexes[node]
+                for i in xrange(new_count, old_count):
+                    for point in md5_points('%s-%s-salt' % (node, i)):
+                        pos = bisect_left(points, point)
+                        if pos < len(points) and points[pos] == point and \
+                                point_nodes[pos] == index:
+                            points.pop(pos)
+                            point_nodes.pop(pos)
+            if new_count == 0 and node in self._node_indexes:
+                # the index slot stays, so the other indexes stay valid
+                nodes[self._node_indexes.pop(node)] = None
+
+        self._circle = (points, point_nodes, nodes)
 
-    def _get_node_pos(self, key):
-        if not self._hashring:
+    def get_node(self, key):
+        points, point_nodes, nodes = self._circle
+        if not points:
             return
 
         if isinstance(key, unicode):
             key = key.encode('utf8')
 
-        k = md5_bytes(key)
-        key = (k[3] << 24) | (k[2] << 16) | (k[1] << 8) | k[0]
-
-        nodes = self._sorted_keys
-        pos = bisect(nodes, key)
-
-        if pos == len(nodes):
-            return 0
-        return pos
-
-    def get_node(self, key):
-        pos = self._get_node_pos(key)
-        if pos is None:
-            return
-        return self._hashring[self._sorted_keys[pos]]
+        point = _key_point_struct.unpack_from(hashlib.md5(key).digest())[0]
+        pos = bisect(points, point)
+        if pos == len(points):
+            pos = 0
+        return nodes[point_nodes[pos]]
+
+    def get_nodes(self, keys):
+        """Returns the nodes of many keys, in the order of the keys."""
+        points, point_nodes, nodes = self._circle
+        if not points:
+            return [None for _ in keys]
+        point_count = len(points)
+        md5 = hashlib.md5
+        unpack_from = _key_point_struct.unpack_from
+        rv = []
+        for key in keys:
+            if isinstance(key, unicode):
+                key = key.encode('utf8')
+            pos = bisect(points, unpack_from(md5(key).digest())[0])
+            if pos == point_count:
+                pos = 0
+            rv.append(nodes[point_nodes[pos]])
+        return rv
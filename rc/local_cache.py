@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """A bounded in-process cache that can be put in front of redis.  It
+    keeps deserialized objects in memory, evicts the least recently used
+    entries once `max_entries` or `max_bytes` is exceeded and expires every
+    entry after at most `max_expire` seconds.  It is thread safe.  Basic
+    example::
+
+        cache = Cache(local_cache=LocalCache(max_entries=1000))
+
+    .. note::
+
+        Values are returned as they are stored, so do not modify a value
+        you get from the cache in place, otherwise the next caller in this
+        process gets the modified value.
+
+    :param max_entries: maximum number of entries kept in memory
+    :param max_bytes: maximum size of all entries, the size of one entry is
+                      the length of its serialized string
+    :param max_expire: maximum expiration time of one entry in seconds, this
+                       bounds how long this process can see a value that has
+                       been changed by another process
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024,
+                 max_expire=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_expire = max_expire
+        #: maps key to (value, size, expires_at), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value for the key, otherwise `default` is returned."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            if entry[2] <= time.time():
+                self._bytes -= entry[1]
+                return default
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, size=0, expire=None):
+        """Adds or overwrites key/value.  The value expires in `expire`
+        seconds, or `max_expire` if that is shorter.
+
+        :param key: cache key
+        :param value: the deserialized value
+        :param size: the size of the value, used for `max_bytes`
+        :param expire: expiration time
+        """
+        if expire is None or expire > self.max_expire:
+            expire = self.max_expire
+        if expire <= 0 or size > self.max_bytes:
+            self.delete(key)
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._bytes -= old_entry[1]
+            self._entries[key] = (value, size, time.time() + expire)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or \
+                    self._bytes > self.max_bytes:
+                _, entry = self._entries.popitem(last=False)
+                self._bytes -= entry[1]
+
+    def delete(self, key):
+        """Deletes the value for the key."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def delete_many(self, keys):
+        """Deletes multiple keys."""
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        """Deletes all keys."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
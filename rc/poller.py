@@ -1,12 +1,66 @@
 # -*- coding: utf-8 -*-
+import errno
 import select
 
 
 class BasePoller(object):
+    """Baseclass for pollers.  A poller can live as long as its owner,
+    objects are registered and unregistered one by one and the poller is
+    closed explicitly with :meth:`close`.  Every object needs a `fileno`
+    method.  Pollers that keep a kernel side registration keep it when an
+    object is unregistered, it is reused when an object with the same
+    socket is registered again.  The socket of an object is its `sock`
+    attribute, or the object itself.
+
+    :param objects: an iterable of (key, object) pairs that are registered
+                    right away
+    """
     is_supported = False
 
-    def __init__(self, objects):
-        self.objects = dict(objects)
+    def __init__(self, objects=()):
+        self.objects = {}
+        self.writable_keys = set()
+        self.closed = False
+        for key, obj in objects:
+            self.register(key, obj)
+
+    def register(self, key, obj, writable=True):
+        """Starts polling one object, it is only reported as writable if
+        `writable` is true, see :meth:`set_writable`.
+        """
+        self.objects[key] = obj
+        if writable:
+            self.writable_keys.add(key)
+        else:
+            self.writable_keys.discard(key)
+
+    def set_writable(self, key, writable):
+        """Sets whether the object for the key is reported as writable.  A
+        socket that has nothing to send is writable all the time, so it
+        should only be polled for writability while it has.
+        """
+        if writable:
+            self.writable_keys.add(key)
+        else:
+            self.writable_keys.discard(key)
+
+    def unregister(self, key):
+        """Stops polling the object for the key, returns the object."""
+        self.writable_keys.discard(key)
+        return self.objects.pop(key, None)
+
+    def pop(self, host_name):
+        return self.unregister(host_name)
+
+    def clear(self):
+        """Unregisters all objects."""
+        for key in self.objects.keys():
+            self.unregister(key)
+
+    def close(self):
+        """Unregisters all objects and frees the resources of the poller."""
+        self.clear()
+        self.closed = True
 
     def poll(self, timeout=None):
         """The return value is two list of objects that are ready:
@@ -14,9 +68,6 @@ class BasePoller(object):
         """
         raise NotImplementedError()
 
-    def pop(self, host_name):
-        return self.objects.pop(host_name, None)
-
     def __len__(self):
         return len(self.objects)
 
@@ -26,73 +77,179 @@ class SelectPoller(BasePoller):
 
     def poll(self, timeout=None):
         objs = self.objects.values()
-        rlist, wlist, _ = select.select(objs, objs, [], timeout)
+        wobjs = [self.objects[key] for key in self.writable_keys]
+        rlist, wlist, _ = select.select(objs, wobjs, [], timeout)
         return rlist, wlist
 
 
-class PollPoller(BasePoller):
-    is_supported = hasattr(select, 'poll')
+class _FdPoller(BasePoller):
+    """Baseclass for pollers that keep a kernel side registration per file
+    descriptor.
+    """
 
-    def __init__(self, objects):
-        BasePoller.__init__(self, objects)
-        self.pollobj = select.poll()
+    def __init__(self, objects=()):
         self.fd_to_object = {}
-        for _, obj in objects:
-            self.pollobj.register(obj.fileno(), select.POLLIN | select.POLLOUT)
-            self.fd_to_object[obj.fileno()] = obj
+        self.key_to_fd = {}
+        #: maps the registered file descriptors to their socket and whether
+        #: they are polled for writability, a registration lives until the
+        #: socket is closed, so the sockets of a connection pool are not
+        #: registered again for every call
+        self.fd_registrations = {}
+        BasePoller.__init__(self, objects)
 
-    def pop(self, host_name):
-        rv = BasePoller.pop(self, host_name)
+    def register(self, key, obj, writable=True):
+        if key in self.objects:
+            self.unregister(key)
+        fd = obj.fileno()
+        sock = getattr(obj, 'sock', obj)
+        registration = self.fd_registrations.get(fd)
+        if registration is None or registration[0] is not sock:
+            # a new socket, the kernel dropped the closed one of this fd
+            self._register_fd(fd, writable)
+        elif registration[1] != writable:
+            self._modify_fd(fd, writable)
+        self.fd_registrations[fd] = (sock, writable)
+        BasePoller.register(self, key, obj, writable)
+        self.fd_to_object[fd] = obj
+        self.key_to_fd[key] = fd
+
+    def set_writable(self, key, writable):
+        BasePoller.set_writable(self, key, writable)
+        fd = self.key_to_fd[key]
+        sock, watched = self.fd_registrations[fd]
+        if watched != writable:
+            self._modify_fd(fd, writable)
+            self.fd_registrations[fd] = (sock, writable)
+
+    def unregister(self, key):
+        rv = BasePoller.unregister(self, key)
         if rv is not None:
-            self.pollobj.unregister(rv.fileno())
-            self.fd_to_object.pop(rv.fileno(), None)
+            fd = self.key_to_fd.pop(key)
+            self.fd_to_object.pop(fd, None)
+            sock, watched = self.fd_registrations[fd]
+            if watched:
+                # idle sockets are writable, they would wake up every poll
+                try:
+                    self._modify_fd(fd, False)
+                    self.fd_registrations[fd] = (sock, False)
+                except (IOError, OSError, ValueError):
+                    # the file is closed already, so the kernel dropped it
+                    self._drop_fd(fd)
         return rv
 
+    def _drop_fd(self, fd):
+        """Removes the registration of a file descriptor that has no object,
+        it is reported if its socket is closed or used by another thread.
+        """
+        self.fd_registrations.pop(fd, None)
+        try:
+            self._unregister_fd(fd)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def close(self):
+        BasePoller.close(self)
+        self.fd_registrations.clear()
+
+    def _register_fd(self, fd, writable):
+        raise NotImplementedError()
+
+    def _modify_fd(self, fd, writable):
+        raise NotImplementedError()
+
+    def _unregister_fd(self, fd):
+        raise NotImplementedError()
+
+
+class PollPoller(_FdPoller):
+    is_supported = hasattr(select, 'poll')
+
+    def __init__(self, objects=()):
+        self.pollobj = select.poll()
+        _FdPoller.__init__(self, objects)
+
+    def _register_fd(self, fd, writable):
+        self.pollobj.register(fd, _poll_events(writable))
+
+    def _modify_fd(self, fd, writable):
+        self.pollobj.modify(fd, _poll_events(writable))
+
+    def _unregister_fd(self, fd):
+        self.pollobj.unregister(fd)
+
     def poll(self, timeout=None):
+        if timeout is not None:
+            # poll takes milliseconds
+            timeout = int(timeout * 1000)
         rlist = []
         wlist = []
         for fd, event in self.pollobj.poll(timeout):
-            obj = self.fd_to_object[fd]
+            obj = self.fd_to_object.get(fd)
+            if obj is None:
+                self._drop_fd(fd)
+                continue
+            # a socket can be readable and writable at the same time
             if event & select.POLLIN:
                 rlist.append(obj)
-            elif event & select.POLLOUT:
+            if event & select.POLLOUT:
                 wlist.append(obj)
         return rlist, wlist
 
 
-class KQueuePoller(BasePoller):
+def _poll_events(writable):
+    if writable:
+        return select.POLLIN | select.POLLOUT
+    return select.POLLIN
+
+
+class KQueuePoller(_FdPoller):
     is_supported = hasattr(select, 'kqueue')
 
-    def __init__(self, objects):
-        BasePoller.__init__(self, objects)
+    def __init__(self, objects=()):
         self.kqueue = select.kqueue()
-        self.events = []
-        self.fd_to_object = {}
-        for _, obj in objects:
-            r_event = select.kevent(
-                obj.fileno(), filter=select.KQ_FILTER_READ,
-                flags=select.KQ_EV_ADD | select.KQ_EV_ENABLE)
-            self.events.append(r_event)
-            w_event = select.kevent(
-                obj.fileno(), filter=select.KQ_FILTER_WRITE,
-                flags=select.KQ_EV_ADD | select.KQ_EV_ENABLE)
-            self.events.append(w_event)
-            self.fd_to_object[obj.fileno()] = obj
+        _FdPoller.__init__(self, objects)
 
-    def pop(self, host_name):
-        rv = BasePoller.pop(self, host_name)
-        if rv is not None:
-            self.events = [e for e in self.events if e.ident != rv.fileno()]
-            self.fd_to_object.pop(rv.fileno(), None)
-        return rv
+    def _write_flags(self, writable):
+        if writable:
+            return select.KQ_EV_ENABLE
+        return select.KQ_EV_DISABLE
+
+    def _register_fd(self, fd, writable):
+        write_flags = select.KQ_EV_ADD | self._write_flags(writable)
+        self.kqueue.control([
+            select.kevent(fd, filter=select.KQ_FILTER_READ,
+                          flags=select.KQ_EV_ADD | select.KQ_EV_ENABLE),
+            select.kevent(fd, filter=select.KQ_FILTER_WRITE,
+                          flags=write_flags),
+        ], 0)
+
+    def _modify_fd(self, fd, writable):
+        self.kqueue.control([
+            select.kevent(fd, filter=select.KQ_FILTER_WRITE,
+                          flags=self._write_flags(writable)),
+        ], 0)
+
+    def _unregister_fd(self, fd):
+        self.kqueue.control([
+            select.kevent(fd, filter=select.KQ_FILTER_READ,
+                          flags=select.KQ_EV_DELETE),
+            select.kevent(fd, filter=select.KQ_FILTER_WRITE,
+                          flags=select.KQ_EV_DELETE),
+        ], 0)
+
+    def close(self):
+        _FdPoller.close(self)
+        self.kqueue.close()
 
     def poll(self, timeout=None):
         rlist = []
         wlist = []
-        events = self.kqueue.control(self.events, 128, timeout)
+        events = self.kqueue.control(None, 2 * len(self.fd_registrations),
+                                     timeout)
         for event in events:
             obj = self.fd_to_object.get(event.ident)
             if obj is None:
+                self._drop_fd(event.ident)
                 continue
             if event.filter == select.KQ_FILTER_READ:
                 rlist.append(obj)
@@ -101,23 +258,32 @@ class KQueuePoller(BasePoller):
         return rlist, wlist
 
 
-class EpollPoller(BasePoller):
+class EpollPoller(_FdPoller):
     is_supported = hasattr(select, 'epoll')
 
-    def __init__(self, objects):
-        BasePoller.__init__(self, objects)
+    def __init__(self, objects=()):
         self.epoll = select.epoll()
-        self.fd_to_object = {}
-        for _, obj in objects:
-            self.fd_to_object[obj.fileno()] = obj
-            self.epoll.register(obj.fileno(), select.EPOLLIN | select.EPOLLOUT)
+        _FdPoller.__init__(self, objects)
 
-    def pop(self, host_name):
-        rv = BasePoller.pop(self, host_name)
-        if rv is not None:
-            self.epoll.unregister(rv.fileno())
-            self.fd_to_object.pop(rv.fileno(), None)
-        return rv
+    def _register_fd(self, fd, writable):
+        events = _epoll_events(writable)
+        try:
+            self.epoll.register(fd, events)
+        except IOError as e:
+            # the file of the fd is still open through another fd
+            if e.errno != errno.EEXIST:
+                raise
+            self.epoll.modify(fd, events)
+
+    def _modify_fd(self, fd, writable):
+        self.epoll.modify(fd, _epoll_events(writable))
+
+    def _unregister_fd(self, fd):
+        self.epoll.unregister(fd)
+
+    def close(self):
+        _FdPoller.close(self)
+        self.epoll.close()
 
     def poll(self, timeout=None):
         if timeout is None:
@@ -125,14 +291,23 @@ class EpollPoller(BasePoller):
         rlist = []
         wlist = []
         for fd, event in self.epoll.poll(timeout):
-            obj = self.fd_to_object[fd]
+            obj = self.fd_to_object.get(fd)
+            if obj is None:
+                self._drop_fd(fd)
+                continue
             if event & select.EPOLLIN:
                 rlist.append(obj)
-            elif event & select.EPOLLOUT:
+            if event & select.EPOLLOUT:
                 wlist.append(obj)
         return rlist, wlist
 
 
+def _epoll_events(writable):
+    if writable:
+        return select.EPOLLIN | select.EPOLLOUT
+    return select.EPOLLIN
+
+
 supported_pollers = [poller for poller in [EpollPoller, KQueuePoller,
                                            PollPoller, SelectPoller]
                      if poller.is_supported]
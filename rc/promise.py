@@ -59,6 +59,31 @@ class Promise(object):
                 on_resolve(self.value)
         return self
 
+    @staticmethod
+    def all(promises):
+        """Returns a promise that is resolved with the list of values of
+        all promises once all of them are resolved.  One demo::
+
+            p1, p2 = Promise(), Promise()
+            p = Promise.all([p1, p2])
+            p1.resolve('value1')
+            p2.resolve('value2')
+            assert p.value == ['value1', 'value2']
+        """
+        promises = list(promises)
+        rv = Promise()
+        pending = [len(promises)]
+
+        def on_resolve(value):
+            pending[0] -= 1
+            if pending[0] == 0:
+                rv.resolve([promise.value for promise in promises])
+        if not promises:
+            rv.resolve([])
+        for promise in promises:
+            promise.then(on_resolve)
+        return rv
+
     def __repr__(self):
         if self._state == PENDING_STATE:
             v = '(pending)'
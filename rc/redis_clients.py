@@ -1,17 +1,46 @@
 # -*- coding: utf-8 -*-
+import sys
 import socket
 import errno
+import threading
+import weakref
+try:
+    import ssl
+except ImportError:
+    ssl = None
 from itertools import izip
 
 from redis import StrictRedis
 from redis.client import list_or_args
-from redis.exceptions import ConnectionError
+from redis.exceptions import ConnectionError, ResponseError
 try:
     from redis.exceptions import TimeoutError
 except ImportError:
     TimeoutError = ConnectionError
 
 from rc.poller import poller
+from rc.redis_router import RedisClusterSlotRouter
+
+
+#: Multi key commands that are split into one command per host, the results
+#: of MGET are joined and the results of the counting commands are added up
+_split_commands = frozenset(['MGET', 'MSET', 'DEL', 'UNLINK', 'EXISTS',
+                             'TOUCH'])
+
+#: Flag for sending without blocking and without switching the socket to
+#: non-blocking mode, not every platform has it
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+def parse_redirect(error):
+    """Returns (kind, slot, host, port) for the ``MOVED`` and ``ASK``
+    errors of redis cluster, `None` for other errors.
+    """
+    parts = str(error).split(' ')
+    if len(parts) != 3 or parts[0] not in ('MOVED', 'ASK'):
+        return None
+    host, _, port = parts[2].rpartition(':')
+    return parts[0], int(parts[1]), host, int(port)
 
 
 class BaseRedisClient(StrictRedis):
@@ -24,35 +53,158 @@ class RedisClient(BaseRedisClient):
 
 class RedisClusterClient(BaseRedisClient):
 
+    #: how many ``MOVED`` and ``ASK`` redirects of redis cluster a command
+    #: follows before the error is raised
+    max_redirects = 16
+
     def __init__(self, connection_pool, max_concurrency=64,
-                 poller_timeout=1.0):
+                 poller_timeout=1.0, max_concurrency_per_server=None,
+                 max_keys_per_command=None):
         BaseRedisClient.__init__(self, connection_pool=connection_pool)
         self.max_concurrency = max_concurrency
         self.poller_timeout = poller_timeout
+        self.max_concurrency_per_server = max_concurrency_per_server
+        self.max_keys_per_command = max_keys_per_command
+        #: every thread has its own poller that lives as long as the thread
+        #: or the client, pollers of threads that are gone are collected
+        self._local = threading.local()
+        self._pollers = weakref.WeakSet()
+        self._pollers_lock = threading.Lock()
+
+    def _get_poller(self):
+        bufs_poll = getattr(self._local, 'poller', None)
+        if bufs_poll is None or bufs_poll.closed:
+            bufs_poll = self._local.poller = poller()
+            with self._pollers_lock:
+                self._pollers.add(bufs_poll)
+        return bufs_poll
+
+    def close(self):
+        """Closes the pollers of all threads, a closed client creates new
+        pollers when it is used again.
+        """
+        with self._pollers_lock:
+            pollers = list(self._pollers)
+            self._pollers.clear()
+        for bufs_poll in pollers:
+            bufs_poll.close()
 
     def execute_command(self, *args, **options):
         command_name = args[0]
         command_args = args[1:]
-        connection_pool = self.connection_pool
-        router = connection_pool.cluster.router
+        router = self.connection_pool.cluster.router
+        if command_name in _split_commands:
+            return self._execute_split_command(command_name, command_args,
+                                               options)
         host_name = router.get_host_for_command(command_name, command_args)
+        return self._execute_command_on_host(host_name, args, options)
+
+    def _execute_command_on_host(self, host_name, args, options):
+        asking = False
+        for _ in xrange(self.max_redirects):
+            try:
+                return self._send_command_to_host(host_name, args, options,
+                                                  asking)
+            except ResponseError as e:
+                redirect = self._follow_redirect(e)
+                if redirect is None:
+                    raise
+                host_name, asking = redirect
+        return self._send_command_to_host(host_name, args, options, asking)
+
+    def _send_command_to_host(self, host_name, args, options, asking=False):
+        command_name = args[0]
+        connection_pool = self.connection_pool
         connection = connection_pool.get_connection(command_name, host_name)
         try:
-            connection.send_command(*args)
-            return self.parse_response(connection, command_name, **options)
+            return self._send_command(connection, args, options, asking)
         except (ConnectionError, TimeoutError) as e:
             connection.disconnect()
             if not connection.retry_on_timeout and isinstance(e, TimeoutError):
                 raise
-            connection.send_command(*args)
-            return self.parse_response(connection, command_name, **options)
+            return self._send_command(connection, args, options, asking)
         finally:
             connection_pool.release(connection)
 
-    def delete(self, name):
-        """We just support one key delete for now."""
-        names = [name]
-        return self.execute_command('DEL', *names)
+    def _send_command(self, connection, args, options, asking):
+        if asking:
+            connection.send_packed_command(
+                connection.pack_commands([('ASKING',), args]))
+            connection.read_response()
+        else:
+            connection.send_command(*args)
+        return self.parse_response(connection, args[0], **options)
+
+    def _follow_redirect(self, error):
+        """Returns the host name and whether ``ASKING`` has to be sent for
+        the ``MOVED`` and ``ASK`` redirects of redis cluster, `None` for
+        other errors.  ``MOVED`` redirects update the router.
+        """
+        router = self.connection_pool.cluster.router
+        redirect = parse_redirect(error)
+        if redirect is None or \
+                not isinstance(router, RedisClusterSlotRouter):
+            return None
+        kind, slot, host, port = redirect
+        host_name = router.get_host_for_address(host, port)
+        if kind == 'MOVED':
+            router.move_slot(slot, host_name)
+            return host_name, False
+        return host_name, True
+
+    def _execute_split_command(self, command_name, command_args, options):
+        """Executes a multi key command whose keys can be on different
+        hosts, every host gets one command with its keys.  With redis
+        cluster every slot gets one command.
+        """
+        router = self.connection_pool.cluster.router
+        step = router.get_key_spec(command_name)[2]
+        group_for_key = router.get_host_for_key
+        if isinstance(router, RedisClusterSlotRouter):
+            # redis cluster refuses keys of different slots in one command
+            group_for_key = router.get_slot_for_key
+        group_positions = {}
+        for i in xrange(0, len(command_args), step):
+            group = group_for_key(command_args[i])
+            group_positions.setdefault(group, []).append(i)
+        if len(group_positions) == 1:
+            return self._execute_command_on_host(
+                router.get_host_for_key(command_args[0]),
+                (command_name,) + command_args, options)
+        command_stack = []
+        for positions in group_positions.itervalues():
+            host_args = [command_name]
+            for i in positions:
+                host_args.extend(command_args[i:i + step])
+            command_stack.append((tuple(host_args), options))
+        # the responses are joined first and parsed once like the response
+        # of one host
+        responses = self._execute_pipeline(command_stack,
+                                           parse_responses=False)
+        if command_name == 'MGET':
+            response = [None] * len(command_args)
+            for positions, values in izip(group_positions.itervalues(),
+                                          responses):
+                for i, value in izip(positions, values):
+                    response[i] = value
+        elif command_name == 'MSET':
+            # MSET never fails, errors are raised by the pipeline anyway
+            response = responses[0]
+        else:
+            response = sum(responses)
+        if command_name in self.response_callbacks:
+            return self.response_callbacks[command_name](response, **options)
+        return response
+
+    def pipeline(self, transaction=False, shard_hint=None):
+        """Returns a :class:`ClusterPipeline` for this client.  The
+        commands can go to different hosts, so transactions are not
+        supported.
+        """
+        if transaction:
+            raise RuntimeError('Transactions are not supported by the '
+                               'cluster client.')
+        return ClusterPipeline(self)
 
     def mdelete(self, *names):
         commands = []
@@ -80,39 +232,162 @@ class RedisClusterClient(BaseRedisClient):
         connection_pool = self.connection_pool
         router = connection_pool.cluster.router
         # put command to the corresponding command buffer
+        command_for_key = dict((args[1], args) for args in commands)
+        host_keys = router.get_hosts_for_keys(args[1] for args in commands)
         bufs = {}
-        for args in commands:
-            host_name = router.get_host_for_key(args[1])
+        for host_name, keys in host_keys.iteritems():
             buf = self._get_command_buffer(bufs, command_name, host_name)
-            buf.enqueue_command(args)
-        # poll all results back with max concurrency
+            for key in keys:
+                buf.enqueue_command(command_for_key[key])
         results = {}
-        remaining_buf_items = bufs.items()
-        while remaining_buf_items:
-            buf_items = remaining_buf_items[:self.max_concurrency]
-            remaining_buf_items = remaining_buf_items[self.max_concurrency:]
-            bufs_poll = poller(buf_items)
-            while bufs_poll:
+        redirects = 0
+        while bufs:
+            for response in self._execute_command_buffers(bufs):
+                results.update(response)
+            bufs = self._get_redirected_command_buffers(command_name, bufs,
+                                                        redirects)
+            redirects += 1
+        return results
+
+    def _get_redirected_command_buffers(self, command_name, bufs, redirects):
+        """Returns new command buffers for the commands that got ``MOVED``
+        or ``ASK`` redirects, the buffers go to the hosts of the redirects.
+        """
+        targets = []
+        for buf in bufs.itervalues():
+            for error, commands in buf.redirects:
+                redirect = self._follow_redirect(error)
+                if redirect is None or redirects >= self.max_redirects:
+                    raise error
+                targets.append((redirect, commands))
+        redirected_bufs = {}
+        for (host_name, asking), commands in targets:
+            buf = self._get_command_buffer(redirected_bufs, command_name,
+                                           host_name)
+            if asking:
+                buf.asking = True
+            for command in commands:
+                buf.enqueue_command(command)
+        return redirected_bufs
+
+    def _execute_pipeline(self, command_stack, raise_on_error=True,
+                          parse_responses=True):
+        connection_pool = self.connection_pool
+        router = connection_pool.cluster.router
+        bufs = {}
+        for index, (args, options) in enumerate(command_stack):
+            host_name = router.get_host_for_command(args[0], args[1:])
+            buf = self._get_command_buffer(bufs, None, host_name,
+                                           PipelineCommandBuffer)
+            buf.parse_responses = parse_responses
+            buf.enqueue_command(args, index, options)
+        results = [None] * len(command_stack)
+        redirects = 0
+        while bufs:
+            redirected = []
+            for response in self._execute_command_buffers(bufs):
+                for index, rv in response:
+                    results[index] = rv
+                    if isinstance(rv, ResponseError) and \
+                            redirects < self.max_redirects:
+                        redirect = self._follow_redirect(rv)
+                        if redirect is not None:
+                            redirected.append((index, redirect))
+            # commands that got redirects are sent again, the others keep
+            # their results
+            bufs = {}
+            for index, (host_name, asking) in redirected:
+                args, options = command_stack[index]
+                buf = self._get_command_buffer(bufs, None, host_name,
+                                               PipelineCommandBuffer)
+                buf.parse_responses = parse_responses
+                if asking:
+                    buf.asking = True
+                buf.enqueue_command(args, index, options)
+            redirects += 1
+        if raise_on_error:
+            for index, rv in enumerate(results):
+                if isinstance(rv, ResponseError):
+                    raise rv.__class__(
+                        'Command # %d %r of pipeline caused error: %s'
+                        % (index + 1, command_stack[index][0], rv))
+        return results
+
+    def _execute_command_buffers(self, bufs):
+        """Sends the command buffers to their hosts in parallel, returns
+        the responses of all buffers.
+        """
+        connection_pool = self.connection_pool
+        # poll all results back with max concurrency, a waiting buffer is
+        # started as soon as one in flight buffer is done
+        responses = []
+        waiting_bufs = bufs.values()
+        server_loads = {}
+        bufs_poll = self._get_poller()
+        try:
+            while waiting_bufs or bufs_poll:
+                if waiting_bufs:
+                    waiting_bufs = self._start_command_buffers(
+                        bufs_poll, waiting_bufs, server_loads)
                 rlist, wlist = bufs_poll.poll(self.poller_timeout)
                 for rbuf in rlist:
-                    if not rbuf.has_pending_request:
-                        results.update(rbuf.fetch_response(self))
-                        bufs_poll.pop(rbuf.host_name)
+                    if rbuf.has_pending_request:
+                        # the first replies can arrive before all commands
+                        # are sent, the rest is sent as the socket allows
+                        if rbuf not in wlist:
+                            self._send_command_buffer(bufs_poll, rbuf)
+                    else:
+                        responses.append(rbuf.fetch_response(self))
+                        bufs_poll.unregister(rbuf.host_name)
+                        server_loads[rbuf.server] -= 1
                 for wbuf in wlist:
                     if wbuf.has_pending_request:
-                        wbuf.send_pending_request()
+                        self._send_command_buffer(bufs_poll, wbuf)
+        finally:
+            # the sockets stay registered in the kernel for the next call
+            bufs_poll.clear()
         # clean
         for _, buf in bufs.iteritems():
             connection_pool.release(buf.connection)
-        return results
+        return responses
+
+    def _start_command_buffers(self, bufs_poll, bufs, server_loads):
+        """Registers as many buffers as the concurrency limits allow,
+        returns the buffers that have to wait.
+        """
+        waiting_bufs = []
+        for buf in bufs:
+            load = server_loads.get(buf.server, 0)
+            if len(bufs_poll) >= self.max_concurrency or \
+                    (self.max_concurrency_per_server is not None and
+                     load >= self.max_concurrency_per_server):
+                waiting_bufs.append(buf)
+                continue
+            # most requests fit into the send buffer of the socket, it is
+            # only polled for writability if a part is left
+            bufs_poll.register(buf.host_name, buf,
+                               not buf.send_pending_request())
+            server_loads[buf.server] = load + 1
+        return waiting_bufs
+
+    def _send_command_buffer(self, bufs_poll, buf):
+        if buf.send_pending_request():
+            bufs_poll.set_writable(buf.host_name, False)
 
-    def _get_command_buffer(self, bufs, command_name, host_name):
+    def _get_command_buffer(self, bufs, command_name, host_name,
+                            buf_cls=None):
         buf = bufs.get(host_name)
         if buf is not None:
             return buf
+        if buf_cls is None:
+            buf_cls = CommandBuffer
         connection_pool = self.connection_pool
         connection = connection_pool.get_connection(command_name, host_name)
-        buf = CommandBuffer(host_name, connection, command_name)
+        server = connection_pool.cluster.hosts[host_name].server
+        buf = buf_cls(host_name, connection, command_name, server,
+                      self.max_keys_per_command)
+        if isinstance(connection_pool.cluster.router, RedisClusterSlotRouter):
+            buf.slot_for_key = connection_pool.cluster.router.get_slot_for_key
         bufs[host_name] = buf
         return buf
 
@@ -122,15 +397,37 @@ class CommandBuffer(object):
     related data.
     """
 
-    def __init__(self, host_name, connection, command_name):
+    def __init__(self, host_name, connection, command_name, server=None,
+                 max_keys_per_command=None):
         self.host_name = host_name
+        #: the redis server of the host, see :attr:`HostConfig.server`
+        self.server = server
         self.connection = connection
         self.command_name = command_name
+        #: MGET and DEL commands are split into chunks of this many keys
+        self.max_keys_per_command = max_keys_per_command
         self.commands = []
-        self.pending_commands = []
+        #: the sent commands, every item is the list of enqueued commands
+        #: that one sent command is made of
+        self.pending_chunks = []
+        #: if this is true ``ASKING`` is sent before every command, for the
+        #: ``ASK`` redirects of redis cluster
+        self.asking = False
+        #: a function that returns the hash slot of a key, if it is set one
+        #: MGET or DEL command only has keys of one slot
+        self.slot_for_key = None
+        #: the ``MOVED`` and ``ASK`` errors of redis cluster with the
+        #: enqueued commands that got them, the client sends them again
+        self.redirects = []
         self._send_buf = []
 
         connection.connect()
+        #: flags for sending without blocking, 0 means the socket has to be
+        #: switched to non-blocking mode for every send, which is also done
+        #: for sockets with a timeout
+        self._send_flags = MSG_DONTWAIT
+        if ssl is not None and isinstance(connection._sock, ssl.SSLSocket):
+            self._send_flags = 0
 
     def assert_open(self):
         if self.connection._sock is None:
@@ -143,35 +440,45 @@ class CommandBuffer(object):
         self.assert_open()
         return self.connection._sock.fileno()
 
+    @property
+    def sock(self):
+        """The socket of the connection, pollers keep its registration
+        across command buffers.
+        """
+        return self.connection._sock
+
     @property
     def has_pending_request(self):
         return self._send_buf or self.commands
 
+    def _send_without_blocking(self, sock, flags):
+        for i, item in enumerate(self._send_buf):
+            try:
+                sent = sock.send(item, flags)
+            except socket.error, e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                sent = 0
+            if sent < len(item):
+                self._send_buf[:i + 1] = [item[sent:]]
+                break
+        else:
+            del self._send_buf[:]
+
     def _try_send_buffer(self):
         sock = self.connection._sock
         try:
-            timeout = sock.gettimeout()
-            sock.setblocking(False)
-            try:
-                for i, item in enumerate(self._send_buf):
-                    sent = 0
-                    while 1:
-                        try:
-                            sent = sock.send(item)
-                        except socket.error, e:
-                            if e.errno == errno.EAGAIN:
-                                continue
-                            elif e.errno == errno.EWOULDBLOCK:
-                                break
-                            raise
-                        break
-                    if sent < len(item):
-                        self._send_buf[:i + 1] = [item[sent:]]
-                        break
-                else:
-                    del self._send_buf[:]
-            finally:
-                sock.settimeout(timeout)
+            # python waits for sockets with a timeout to be writable before
+            # it sends, even with MSG_DONTWAIT
+            if self._send_flags and sock.gettimeout() is None:
+                self._send_without_blocking(sock, self._send_flags)
+            else:
+                timeout = sock.gettimeout()
+                sock.setblocking(False)
+                try:
+                    self._send_without_blocking(sock, 0)
+                finally:
+                    sock.settimeout(timeout)
         except socket.timeout:
             self.connection.disconnect()
             raise TimeoutError('Timeout writing to socket (%s)'
@@ -185,24 +492,42 @@ class CommandBuffer(object):
             raise
 
     def batch_commands(self, commands):
-        args = []
-        for command in commands:
-            command_args = command[1:]
-            args.extend(command_args)
-        if args:
-            return [(self.command_name,) + tuple(args)]
+        """Splits the enqueued commands into chunks of at most
+        `max_keys_per_command` commands, every chunk is sent as one MGET or
+        DEL command.
+        """
+        if self.slot_for_key is not None:
+            slot_commands = {}
+            for command in commands:
+                slot_commands.setdefault(self.slot_for_key(command[1]),
+                                         []).append(command)
+            groups = slot_commands.values()
         else:
-            return []
+            groups = [commands]
+        chunk_size = self.max_keys_per_command or len(commands)
+        return [group[i:i + chunk_size] for group in groups
+                for i in xrange(0, len(group), chunk_size)]
 
     def send_pending_request(self):
         self.assert_open()
         if self.commands:
             if self.command_name in ('MGET', 'DEL'):
-                commands = self.batch_commands(self.commands)
+                chunks = self.batch_commands(self.commands)
             else:
-                commands = self.commands
+                chunks = [[command] for command in self.commands]
+            commands = []
+            for chunk in chunks:
+                if self.asking:
+                    commands.append(('ASKING',))
+                if len(chunk) == 1:
+                    commands.append(chunk[0])
+                else:
+                    args = [self.command_name]
+                    for command in chunk:
+                        args.extend(command[1:])
+                    commands.append(tuple(args))
             self._send_buf.extend(self.connection.pack_commands(commands))
-            self.pending_commands = self.commands
+            self.pending_chunks = chunks
             self.commands = []
         if not self._send_buf:
             return True
@@ -213,14 +538,116 @@ class CommandBuffer(object):
         self.assert_open()
         if self.has_pending_request:
             raise RuntimeError('There are pending requests.')
-        if self.command_name in ('MGET', 'DEL'):
-            rv = client.parse_response(self.connection, self.command_name)
-        else:
-            rv = []
-            for i in xrange(len(self.pending_commands)):
-                rv.append(client.parse_response(
-                    self.connection, self.command_name))
-        if self.command_name == 'DEL':
-            rv = [1] * rv + [0] * (len(self.pending_commands) - rv)
-        pending_keys = map(lambda c: c[1], self.pending_commands)
-        return dict(izip(pending_keys, rv))
+        rv = {}
+        error = None
+        for chunk in self.pending_chunks:
+            if self.asking:
+                self.connection.read_response()
+            try:
+                response = client.parse_response(self.connection,
+                                                  self.command_name)
+            except ResponseError as e:
+                # all responses are read before an error is raised
+                if parse_redirect(e) is not None:
+                    self.redirects.append((e, chunk))
+                elif error is None:
+                    error = e
+                continue
+            keys = [command[1] for command in chunk]
+            if self.command_name == 'MGET':
+                rv.update(izip(keys, response))
+            elif self.command_name == 'DEL':
+                rv.update((key, int(i < response))
+                          for i, key in enumerate(keys))
+            else:
+                rv[keys[0]] = response
+        if error is not None:
+            raise error
+        return rv
+
+
+class PipelineCommandBuffer(CommandBuffer):
+    """The command buffer for the commands of a cluster pipeline that go to
+    one host.  Commands are sent as they are and the responses are returned
+    with the index of their command in the pipeline.
+    """
+
+    def __init__(self, host_name, connection, command_name=None, server=None,
+                 max_keys_per_command=None):
+        CommandBuffer.__init__(self, host_name, connection, None, server)
+        self.indexes = []
+        self.options = []
+        #: if this is false the raw responses are returned
+        self.parse_responses = True
+
+    def enqueue_command(self, command, index, options):
+        self.commands.append(command)
+        self.indexes.append(index)
+        self.options.append(options)
+
+    def fetch_response(self, client):
+        self.assert_open()
+        if self.has_pending_request:
+            raise RuntimeError('There are pending requests.')
+        rv = []
+        for index, chunk, options in izip(self.indexes, self.pending_chunks,
+                                          self.options):
+            command = chunk[0]
+            if self.asking:
+                self.connection.read_response()
+            try:
+                if self.parse_responses:
+                    response = client.parse_response(
+                        self.connection, command[0], **options)
+                else:
+                    response = self.connection.read_response()
+                rv.append((index, response))
+            except ResponseError:
+                rv.append((index, sys.exc_info()[1]))
+        return rv
+
+
+class ClusterPipeline(BaseRedisClient):
+    """A pipeline for :class:`RedisClusterClient`.  Commands are queued
+    until :meth:`execute` is called, then all commands for one host are
+    sent to it with one pipeline and the hosts are queried in parallel.
+    The results are returned in the order of the commands.  Example::
+
+        with client.pipeline() as pipe:
+            pipe.incr('counter').expire('counter', 60)
+            pipe.hget('user:1', 'name')
+            counter, _, name = pipe.execute()
+    """
+
+    def __init__(self, client):
+        BaseRedisClient.__init__(self, connection_pool=client.connection_pool)
+        self.client = client
+        self.command_stack = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def reset(self):
+        """Drops all queued commands."""
+        self.command_stack = []
+
+    def execute_command(self, *args, **options):
+        self.command_stack.append((args, options))
+        return self
+
+    def execute(self, raise_on_error=True):
+        """Executes all queued commands and returns their results.  If
+        `raise_on_error` is false, failed commands return their
+        :class:`~redis.exceptions.ResponseError` instead of raising it.
+        """
+        command_stack = self.command_stack
+        if not command_stack:
+            return []
+        self.reset()
+        return self.client._execute_pipeline(command_stack, raise_on_error)
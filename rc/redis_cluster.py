@@ -15,7 +15,7 @@ class HostConfig(object):
 
     def __init__(self, host_name, host='localhost', port=6379,
                  unix_socket_path=None, db=0, password=None,
-                 ssl=False, ssl_options=None):
+                 ssl=False, ssl_options=None, weight=1):
         self.host_name = host_name
         self.host = host
         self.port = port
@@ -24,6 +24,18 @@ class HostConfig(object):
         self.password = password
         self.ssl = ssl
         self.ssl_options = ssl_options
+        #: the share of keys of this host relative to the other hosts, for
+        #: routers that support weights
+        self.weight = weight
+
+    @property
+    def server(self):
+        """Identifies the redis server of this host, hosts that only use
+        different databases share one server.
+        """
+        if self.unix_socket_path is not None:
+            return self.unix_socket_path
+        return (self.host, self.port)
 
     def __repr__(self):
         identity_dict = {
@@ -99,7 +111,26 @@ class RedisCluster(object):
             self._pools[host_name] = pool
             return pool
 
-    def get_client(self, max_concurrency=64, poller_timeout=1.0):
+    def add_host(self, host_name, **host_config):
+        """Adds a host to the cluster, or replaces the config of a host.
+        The parameters are used to construct a
+        :class:`~rc.redis_cluster.HostConfig`.
+        """
+        self.router.add_host(host_name, HostConfig(host_name, **host_config))
+        pool = self._pools.pop(host_name, None)
+        if pool is not None:
+            pool.disconnect()
+
+    def remove_host(self, host_name):
+        """Removes a host from the cluster and closes its connections."""
+        self.router.remove_host(host_name)
+        pool = self._pools.pop(host_name, None)
+        if pool is not None:
+            pool.disconnect()
+
+    def get_client(self, max_concurrency=64, poller_timeout=1.0,
+                   max_concurrency_per_server=None,
+                   max_keys_per_command=None):
         """Returns a cluster client.  This client can automatically route
         the requests to the corresponding node.
 
@@ -109,9 +140,18 @@ class RedisCluster(object):
                                the parallel query implementation, use this
                                to specify timeout for underlying pollers
                                (select/poll/kqueue/epoll).
+        :param max_concurrency_per_server: defines how many parallel queries
+                                           can happen at the same time on one
+                                           redis server, `None` means no
+                                           limit other than `max_concurrency`
+        :param max_keys_per_command: multi key commands send at most this
+                                     many keys with one MGET or DEL command,
+                                     more keys are split into several
+                                     pipelined commands
         """
         return RedisClusterClient(
-            RedisClusterPool(self), max_concurrency, poller_timeout)
+            RedisClusterPool(self), max_concurrency, poller_timeout,
+            max_concurrency_per_server, max_keys_per_command)
 
 
 class RedisClusterPool(object):
@@ -1,36 +1,286 @@
 # -*- coding: utf-8 -*-
+import copy
+import math
+import struct
+import hashlib
+import threading
 from binascii import crc32
+from itertools import izip
+
+from redis import StrictRedis
+from redis.exceptions import ConnectionError
 
 from rc.ketama import HashRing
 
 
+_MASK_64 = (1 << 64) - 1
+_hash64_struct = struct.Struct('<Q')
+
+
+def _hash64(key):
+    """Returns a 64 bit hash of a key."""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    else:
+        key = str(key)
+    return _hash64_struct.unpack_from(hashlib.md5(key).digest())[0]
+
+
+def _mix64(x):
+    """The splitmix64 finalizer, it spreads the bits of a 64 bit
+    integer.
+    """
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK_64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK_64
+    return x ^ (x >> 31)
+
+
+def jump_hash(key, bucket_count):
+    """Jump consistent hash, maps a 64 bit key to one of `bucket_count`
+    buckets.  Adding a bucket only moves the keys that go to the new
+    bucket.
+    """
+    b, j = -1, 0
+    while j < bucket_count:
+        b = j
+        key = (key * 2862933555777941757 + 1) & _MASK_64
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def extract_hash_tag(key):
+    """Returns the hash tag of a key, the part between the first ``{`` and
+    the following ``}``.  Keys without a non-empty tag are returned as they
+    are.
+    """
+    if not isinstance(key, basestring):
+        return key
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def _make_crc16_table():
+    table = []
+    for i in xrange(256):
+        crc = i << 8
+        for _ in xrange(8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ 0x1021
+            else:
+                crc <<= 1
+        table.append(crc & 0xffff)
+    return table
+
+
+_crc16_table = _make_crc16_table()
+
+#: The number of hash slots of redis cluster
+CLUSTER_SLOT_COUNT = 16384
+
+
+def crc16(data):
+    """The CRC16 (XMODEM) checksum of a byte string, redis cluster uses it
+    for hash slots.
+    """
+    crc = 0
+    table = _crc16_table
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xff00) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+def key_hash_slot(key):
+    """Returns the redis cluster hash slot of a key, only the hash tag of
+    the key is hashed if it has one.
+    """
+    key = extract_hash_tag(key)
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    else:
+        key = str(key)
+    return crc16(key) % CLUSTER_SLOT_COUNT
+
+
+def _key_specs(spec, commands):
+    return [(command, spec) for command in commands.split()]
+
+
+#: Maps every supported command to the positions of its keys in the command
+#: arguments: (first key, last key, step), a negative last key counts from
+#: the end.  Routers look commands up here, assign a new dictionary to
+#: :attr:`BaseRedisRouter.command_key_specs` to support more commands.
+COMMAND_KEY_SPECS = dict(
+    # commands with one key that is the first argument
+    _key_specs((0, 0, 1), """
+        GET SET SETEX PSETEX SETNX GETSET GETDEL GETEX APPEND STRLEN GETRANGE
+        SETRANGE GETBIT SETBIT BITCOUNT BITPOS BITFIELD
+        INCR INCRBY INCRBYFLOAT DECR DECRBY
+        TYPE EXPIRE PEXPIRE EXPIREAT PEXPIREAT TTL PTTL PERSIST DUMP RESTORE
+        SORT
+        HGET HSET HSETNX HDEL HEXISTS HGETALL HINCRBY HINCRBYFLOAT HKEYS HVALS
+        HLEN HMGET HMSET HSTRLEN HSCAN HRANDFIELD
+        LPUSH RPUSH LPUSHX RPUSHX LPOP RPOP LLEN LRANGE LINDEX LREM LTRIM LSET
+        LINSERT LPOS
+        SADD SREM SCARD SISMEMBER SMISMEMBER SMEMBERS SPOP SRANDMEMBER SSCAN
+        ZADD ZREM ZSCORE ZMSCORE ZINCRBY ZCARD ZCOUNT ZLEXCOUNT ZRANK ZREVRANK
+        ZRANGE ZREVRANGE ZRANGEBYSCORE ZREVRANGEBYSCORE ZRANGEBYLEX
+        ZREVRANGEBYLEX ZREMRANGEBYRANK ZREMRANGEBYSCORE ZREMRANGEBYLEX
+        ZPOPMIN ZPOPMAX ZRANDMEMBER ZSCAN
+        PFADD
+        GEOADD GEODIST GEOHASH GEOPOS GEORADIUS GEORADIUSBYMEMBER GEOSEARCH
+        XADD XLEN XRANGE XREVRANGE XDEL XTRIM XACK XCLAIM XAUTOCLAIM XPENDING
+    """) +
+    # commands with a list of keys
+    _key_specs((0, -1, 1), """
+        DEL UNLINK EXISTS TOUCH MGET WATCH SDIFF SINTER SUNION SDIFFSTORE
+        SINTERSTORE SUNIONSTORE PFCOUNT PFMERGE
+    """) +
+    # commands with key value pairs
+    _key_specs((0, -1, 2), 'MSET MSETNX') +
+    # commands with a source and a destination key
+    _key_specs((0, 1, 1), """
+        RENAME RENAMENX RPOPLPUSH BRPOPLPUSH LMOVE BLMOVE SMOVE COPY
+        GEOSEARCHSTORE
+    """) +
+    # blocking commands with keys and a timeout
+    _key_specs((0, -2, 1), 'BLPOP BRPOP BZPOPMIN BZPOPMAX') +
+    _key_specs((1, -1, 1), 'BITOP') +
+    _key_specs((1, 1, 1), 'OBJECT') +
+    # scripts are routed by their first key, the number of keys comes first
+    _key_specs((2, 2, 1), 'EVAL EVALSHA')
+)
+
+
 class BaseRedisRouter(object):
-    """Subclass this to implement your own router."""
+    """Subclass this to implement your own router.
+
+    :param hosts: the hosts of the cluster, a dictionary that maps host names
+                  to :class:`~rc.redis_cluster.HostConfig`
+    :param memo_size: :meth:`get_hosts_for_keys` remembers the hosts of up
+                      to this many keys, by default nothing is remembered
+    :param hash_tags: if this is true only the part of a key between the
+                      first ``{`` and the following ``}`` is hashed, if
+                      there is such a non-empty part, so keys with the same
+                      tag go to the same host.  Routers call
+                      :func:`extract_hash_tag` in :meth:`get_host_for_key`
+                      for this.
+    """
 
-    def __init__(self, hosts):
+    #: the key positions of the supported commands, see
+    #: :data:`COMMAND_KEY_SPECS`
+    command_key_specs = COMMAND_KEY_SPECS
+
+    def __init__(self, hosts, memo_size=0, hash_tags=False):
         self.hosts = hosts
+        self.memo_size = memo_size
+        self.hash_tags = hash_tags
+        self._memo = {}
+
+    def get_key_spec(self, command):
+        """Returns the key positions of a command as (first key, last key,
+        step).
+        """
+        try:
+            return self.command_key_specs[command]
+        except KeyError:
+            spec = self.command_key_specs.get(command.upper())
+            if spec is None:
+                raise RuntimeError('The command "%s" is not supported yet.'
+                                   % command)
+            return spec
+
+    def get_keys_for_command(self, command, args):
+        """Returns all keys of a command."""
+        first, last, step = self.get_key_spec(command)
+        if last < 0:
+            last += len(args)
+        return args[first:last + 1:step]
 
     def get_key_for_command(self, command, args):
-        if command in ('GET', 'SET', 'SETEX', 'DEL'):
-            return args[0]
-        raise RuntimeError('The command "%s" is not supported yet.' % command)
+        """Returns the key of a command that has one key."""
+        first, last, step = self.get_key_spec(command)
+        if first != last:
+            raise RuntimeError('The command "%s" has multiple keys.'
+                               % command)
+        return args[first]
 
     def get_host_for_key(self, key):
         """Get host name for a certain key."""
         raise NotImplementedError()
 
+    def add_host(self, host_name, host_config):
+        """Adds a host, or replaces the config of a host.  Routers that
+        keep their own state of the hosts extend this.
+        """
+        self.hosts[host_name] = host_config
+        self._memo.clear()
+
+    def remove_host(self, host_name):
+        """Removes a host."""
+        self.hosts.pop(host_name, None)
+        self._memo.clear()
+
+    def get_hosts_for_keys(self, keys):
+        """Groups keys by host, returns a dictionary that maps host names to
+        lists of keys.
+        """
+        rv = {}
+        memo = self._memo
+        memo_size = self.memo_size
+        get_host_for_key = self.get_host_for_key
+        for key in keys:
+            host_name = memo.get(key) if memo_size else None
+            if host_name is None:
+                host_name = get_host_for_key(key)
+                if memo_size:
+                    # the memo is bounded, it starts over once it is full
+                    if len(memo) >= memo_size:
+                        memo.clear()
+                    memo[key] = host_name
+            keys_of_host = rv.get(host_name)
+            if keys_of_host is None:
+                rv[host_name] = [key]
+            else:
+                keys_of_host.append(key)
+        return rv
+
     def get_host_for_command(self, command, args):
-        return self.get_host_for_key(self.get_key_for_command(command, args))
+        """Returns the host for a command, all keys of the command have to
+        be on this host.
+        """
+        first, last, step = self.get_key_spec(command)
+        if first == last:
+            return self.get_host_for_key(args[first])
+        host_keys = self.get_hosts_for_keys(
+            self.get_keys_for_command(command, args))
+        if len(host_keys) != 1:
+            raise RuntimeError('The keys of command "%s" are not on one host.'
+                               % command)
+        return host_keys.keys()[0]
 
 
 class RedisCRC32HashRouter(BaseRedisRouter):
     """Use crc32 for hash partitioning."""
 
-    def __init__(self, hosts):
-        BaseRedisRouter.__init__(self, hosts)
+    def __init__(self, hosts, memo_size=0, hash_tags=False):
+        BaseRedisRouter.__init__(self, hosts, memo_size, hash_tags)
         self._sorted_host_names = sorted(hosts.keys())
 
+    def add_host(self, host_name, host_config):
+        BaseRedisRouter.add_host(self, host_name, host_config)
+        self._sorted_host_names = sorted(self.hosts.keys())
+
+    def remove_host(self, host_name):
+        BaseRedisRouter.remove_host(self, host_name)
+        self._sorted_host_names = sorted(self.hosts.keys())
+
     def get_host_for_key(self, key):
+        if self.hash_tags:
+            key = extract_hash_tag(key)
         if isinstance(key, unicode):
             key = key.encode('utf-8')
         else:
@@ -38,16 +288,300 @@ class RedisCRC32HashRouter(BaseRedisRouter):
         pos = crc32(key) % len(self._sorted_host_names)
         return self._sorted_host_names[pos]
 
+    def get_hosts_for_keys(self, keys):
+        if self.memo_size or self.hash_tags:
+            return BaseRedisRouter.get_hosts_for_keys(self, keys)
+        # without a memo we hash inline and skip the method calls
+        host_names = self._sorted_host_names
+        host_count = len(host_names)
+        key_lists = [[] for _ in xrange(host_count)]
+        for key in keys:
+            if isinstance(key, unicode):
+                hash_key = key.encode('utf-8')
+            else:
+                hash_key = str(key)
+            key_lists[crc32(hash_key) % host_count].append(key)
+        return dict((host_names[pos], key_list)
+                    for pos, key_list in enumerate(key_lists) if key_list)
+
 
 class RedisConsistentHashRouter(BaseRedisRouter):
-    """Use ketama for hash partitioning."""
+    """Use ketama for hash partitioning.  Hosts get a share of the keys
+    that is proportional to their `weight`.  Adding or removing a host only
+    moves the keys of the changed share.
+    """
+
+    def __init__(self, hosts, memo_size=0, hash_tags=False):
+        BaseRedisRouter.__init__(self, hosts, memo_size, hash_tags)
+        self._hashring = HashRing(hosts.values(),
+                                  dict((host_config, host_config.weight)
+                                       for host_config in hosts.values()))
+
+    def add_host(self, host_name, host_config):
+        old_host_config = self.hosts.get(host_name)
+        if old_host_config is not None:
+            self._hashring.remove_node(old_host_config)
+        self._hashring.add_node(host_config, host_config.weight)
+        BaseRedisRouter.add_host(self, host_name, host_config)
 
-    def __init__(self, hosts):
-        BaseRedisRouter.__init__(self, hosts)
-        self._hashring = HashRing(hosts.values())
+    def remove_host(self, host_name):
+        host_config = self.hosts.get(host_name)
+        if host_config is not None:
+            self._hashring.remove_node(host_config)
+        BaseRedisRouter.remove_host(self, host_name)
 
     def get_host_for_key(self, key):
+        if self.hash_tags:
+            key = extract_hash_tag(key)
         node = self._hashring.get_node(key)
         if node is None:
             raise RuntimeError('Can not find a host using consistent hash')
         return node.host_name
+
+    def get_hosts_for_keys(self, keys):
+        if self.memo_size or self.hash_tags:
+            return BaseRedisRouter.get_hosts_for_keys(self, keys)
+        if not isinstance(keys, (list, tuple)):
+            keys = list(keys)
+        rv = {}
+        for key, node in izip(keys, self._hashring.get_nodes(keys)):
+            if node is None:
+                raise RuntimeError('Can not find a host using consistent '
+                                   'hash')
+            keys_of_host = rv.get(node.host_name)
+            if keys_of_host is None:
+                rv[node.host_name] = [key]
+            else:
+                keys_of_host.append(key)
+        return rv
+
+
+class RedisJumpHashRouter(BaseRedisRouter):
+    """Use jump consistent hash for hash partitioning.  It needs no memory
+    per host and the keys are spread almost perfectly even.  Hosts are
+    ordered by name, and adding a host whose name sorts last moves only
+    the keys of the new host.  Removing or adding other hosts moves more
+    keys, so give new hosts names that sort last, like increasing numbers.
+    """
+
+    def __init__(self, hosts, memo_size=0, hash_tags=False):
+        BaseRedisRouter.__init__(self, hosts, memo_size, hash_tags)
+        self._sorted_host_names = sorted(hosts.keys())
+
+    def add_host(self, host_name, host_config):
+        BaseRedisRouter.add_host(self, host_name, host_config)
+        self._sorted_host_names = sorted(self.hosts.keys())
+
+    def remove_host(self, host_name):
+        BaseRedisRouter.remove_host(self, host_name)
+        self._sorted_host_names = sorted(self.hosts.keys())
+
+    def get_host_for_key(self, key):
+        if self.hash_tags:
+            key = extract_hash_tag(key)
+        host_names = self._sorted_host_names
+        return host_names[jump_hash(_hash64(key), len(host_names))]
+
+
+class RedisRendezvousHashRouter(BaseRedisRouter):
+    """Use weighted rendezvous hashing (highest random weight) for hash
+    partitioning.  Every host gets a score for a key, the key goes to the
+    host with the highest score.  Hosts get a share of the keys that is
+    proportional to their `weight`, adding or removing any host only moves
+    the keys of that host.  A lookup scores every host, so it is slower
+    than the other routers for many hosts.
+    """
+
+    def __init__(self, hosts, memo_size=0, hash_tags=False):
+        BaseRedisRouter.__init__(self, hosts, memo_size, hash_tags)
+        self._rebuild()
+
+    def _rebuild(self):
+        self._host_seeds = [(_hash64(host_name), host_name,
+                             float(host_config.weight))
+                            for host_name, host_config in
+                            self.hosts.iteritems()]
+        self._weighted = len(set(seed[2] for seed in self._host_seeds)) > 1
+
+    def add_host(self, host_name, host_config):
+        BaseRedisRouter.add_host(self, host_name, host_config)
+        self._rebuild()
+
+    def remove_host(self, host_name):
+        BaseRedisRouter.remove_host(self, host_name)
+        self._rebuild()
+
+    def get_host_for_key(self, key):
+        if self.hash_tags:
+            key = extract_hash_tag(key)
+        if not self._host_seeds:
+            raise RuntimeError('Can not find a host using rendezvous hash')
+        key_hash = _hash64(key)
+        best_score = None
+        best_host_name = None
+        if self._weighted:
+            log = math.log
+            for seed, host_name, weight in self._host_seeds:
+                # the top 53 bits give a uniform value in (0, 1) that is
+                # exact as a float, a bigger weight raises the score
+                uniform = ((_mix64(key_hash ^ seed) >> 11) + 0.5) / \
+                    9007199254740992.0
+                score = -weight / log(uniform)
+                if best_score is None or score > best_score:
+                    best_score = score
+                    best_host_name = host_name
+        else:
+            for seed, host_name, weight in self._host_seeds:
+                score = _mix64(key_hash ^ seed)
+                if best_score is None or score > best_score:
+                    best_score = score
+                    best_host_name = host_name
+        return best_host_name
+
+
+class RedisClusterSlotRouter(BaseRedisRouter):
+    """Routes keys like redis cluster does, for a cluster of redis servers
+    that run in cluster mode.  Every key belongs to one of 16384 hash slots
+    and the router keeps a table of the host of every slot.  The table is
+    loaded with ``CLUSTER SLOTS`` from any of the hosts when it is first
+    used, so the hosts only need to contain some of the nodes, the other
+    nodes are added as they are found.
+
+    The cluster client follows the ``MOVED`` and ``ASK`` redirects of the
+    nodes.  A ``MOVED`` redirect changes the slot right away and the whole
+    table is loaded again before the next key is routed.  Hash tags are
+    always used, like redis cluster does.
+
+    :param hash_tags: can only be true, it is accepted so router options
+                      with ``hash_tags`` work with this router too
+    :param socket_timeout: the socket timeout of the connections that load
+                           the slot table
+    """
+
+    def __init__(self, hosts, memo_size=0, hash_tags=True,
+                 socket_timeout=None):
+        if not hash_tags:
+            raise RuntimeError('Redis cluster always uses hash tags.')
+        BaseRedisRouter.__init__(self, hosts, memo_size, True)
+        self.socket_timeout = socket_timeout
+        #: the host name of every slot, `None` until it is loaded
+        self._slots = None
+        self._slots_stale = True
+        self._lock = threading.Lock()
+
+    def get_slot_for_key(self, key):
+        """Returns the hash slot of a key."""
+        return key_hash_slot(key)
+
+    def get_host_for_address(self, host, port):
+        """Returns the name of the host for the address of a cluster node,
+        nodes that are not known yet are added with the config of a known
+        host, so they have the same password and ssl options.
+        """
+        for host_name, host_config in self.hosts.items():
+            if host_config.server == (host, port):
+                return host_name
+        host_name = '%s:%s' % (host, port)
+        host_config = copy.copy(self.hosts.itervalues().next())
+        host_config.host_name = host_name
+        host_config.host = host
+        host_config.port = port
+        host_config.unix_socket_path = None
+        host_config.db = 0
+        BaseRedisRouter.add_host(self, host_name, host_config)
+        return host_name
+
+    def add_host(self, host_name, host_config):
+        BaseRedisRouter.add_host(self, host_name, host_config)
+        self._slots_stale = True
+
+    def remove_host(self, host_name):
+        BaseRedisRouter.remove_host(self, host_name)
+        self._slots_stale = True
+
+    def move_slot(self, slot, host_name):
+        """Moves a slot to another host after a ``MOVED`` redirect, the
+        other slots are loaded again before the next key is routed.
+        """
+        slots = self._slots
+        if slots is not None:
+            slots[slot] = host_name
+        self._memo.clear()
+        self._slots_stale = True
+
+    def _query_slots(self, host_config):
+        options = {'password': host_config.password,
+                   'socket_timeout': self.socket_timeout}
+        if host_config.unix_socket_path is not None:
+            options['unix_socket_path'] = host_config.unix_socket_path
+        else:
+            options['host'] = host_config.host
+            options['port'] = host_config.port
+            if host_config.ssl:
+                options['ssl'] = True
+                options.update(host_config.ssl_options or {})
+        client = StrictRedis(**options)
+        try:
+            return client.execute_command('CLUSTER SLOTS')
+        finally:
+            client.connection_pool.disconnect()
+
+    def refresh_slots(self):
+        """Loads the slot table from the first host that answers."""
+        error = None
+        for host_name in sorted(self.hosts):
+            host_config = self.hosts.get(host_name)
+            if host_config is None:
+                continue
+            try:
+                ranges = self._query_slots(host_config)
+            except ConnectionError as e:
+                error = e
+                continue
+            slots = [None] * CLUSTER_SLOT_COUNT
+            for slot_range in ranges:
+                start, end, master = slot_range[:3]
+                host = master[0]
+                if not host:
+                    # a node that does not know its own address sends an
+                    # empty one
+                    host = host_config.host
+                slots[start:end + 1] = [self.get_host_for_address(
+                    host, int(master[1]))] * (end - start + 1)
+            self._slots = slots
+            self._slots_stale = False
+            self._memo.clear()
+            return
+        raise ConnectionError('Can not load the slot table of the '
+                              'cluster: %s' % error)
+
+    def _get_slots(self):
+        if self._slots_stale:
+            with self._lock:
+                if self._slots_stale:
+                    self.refresh_slots()
+        return self._slots
+
+    def get_host_for_key(self, key):
+        slot = key_hash_slot(key)
+        host_name = self._get_slots()[slot]
+        if host_name is None:
+            raise RuntimeError('No host serves the hash slot %d' % slot)
+        return host_name
+
+    def get_hosts_for_keys(self, keys):
+        if self.memo_size:
+            return BaseRedisRouter.get_hosts_for_keys(self, keys)
+        slots = self._get_slots()
+        rv = {}
+        for key in keys:
+            slot = key_hash_slot(key)
+            host_name = slots[slot]
+            if host_name is None:
+                raise RuntimeError('No host serves the hash slot %d' % slot)
+            keys_of_host = rv.get(host_name)
+            if keys_of_host is None:
+                rv[host_name] = [key]
+            else:
+                keys_of_host.append(key)
+        return rv
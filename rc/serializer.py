@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 import json
+import marshal
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class BaseSerializer(object):
@@ -17,12 +22,43 @@ class BaseSerializer(object):
         """Read a serialized object from a string."""
         raise NotImplementedError()
 
+    def dumps_many(self, objs):
+        """Dumps a list of objects into a list of strings.  Override this if
+        there is a faster way than calling :meth:`dumps` for every object.
+
+        .. versionadded:: 0.4
+        """
+        dumps = self.dumps
+        return [dumps(obj) for obj in objs]
+
+    def loads_many(self, strings):
+        """Read a list of serialized objects from a list of strings, which
+        might contain `None`.  Override this if there is a faster way than
+        calling :meth:`loads` for every string.
+
+        .. versionadded:: 0.4
+        """
+        loads = self.loads
+        return [loads(string) for string in strings]
+
 
 class PickleSerializer(BaseSerializer):
-    """One serializer that uses Pickle"""
+    """One serializer that uses Pickle
+
+    :param protocol: the pickle protocol, it is 0 by default.  Protocol 2 or
+                     :data:`pickle.HIGHEST_PROTOCOL` is a lot faster and
+                     smaller, but it is binary and older Python versions
+                     might not read it.
+
+    .. versionadded:: 0.4
+        The `protocol` parameter was added.
+    """
+
+    def __init__(self, protocol=0):
+        self.protocol = protocol
 
     def dumps(self, obj):
-        return pickle.dumps(obj)
+        return pickle.dumps(obj, self.protocol)
 
     def loads(self, string):
         if string is None:
@@ -40,3 +76,54 @@ class JSONSerializer(BaseSerializer):
         if string is None:
             return
         return json.loads(string)
+
+
+class MsgpackSerializer(BaseSerializer):
+    """One serializer that uses msgpack, it depends on the `msgpack`_
+    library.  Byte strings and unicode strings are kept apart.
+
+    .. _msgpack: https://github.com/msgpack/msgpack-python
+
+    .. versionadded:: 0.4
+    """
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('MsgpackSerializer requires msgpack')
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, string):
+        if string is None:
+            return
+        return msgpack.unpackb(string, raw=False)
+
+    def dumps_many(self, objs):
+        # packers are not thread safe, so we use one for every call
+        pack = msgpack.Packer(use_bin_type=True).pack
+        return [pack(obj) for obj in objs]
+
+    def loads_many(self, strings):
+        # every string is unpacked on its own, so one bad string can not
+        # shift the others
+        unpackb = msgpack.unpackb
+        return [None if string is None else unpackb(string, raw=False)
+                for string in strings]
+
+
+class MarshalSerializer(BaseSerializer):
+    """One serializer that uses marshal.  It is very fast, but it only
+    supports builtin types and the format can change between Python
+    versions.
+
+    .. versionadded:: 0.4
+    """
+
+    def dumps(self, obj):
+        return marshal.dumps(obj, 2)
+
+    def loads(self, string):
+        if string is None:
+            return
+        return marshal.loads(string)
@@ -24,6 +24,14 @@ class NullCache(BaseCache):
         """Always return a list of `None`"""
         return [None for key in keys]
 
+    def set_many(self, mapping, expire=None):
+        """Always return `True`"""
+        return True
+
+    def delete_many(self, *keys):
+        """Always return `True`"""
+        return True
+
 
 class FakeRedisCache(BaseCache):
     """Uses a fake redis server as backend.  It depends on the
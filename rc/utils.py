@@ -1,3 +1,12 @@
+import struct
+import inspect
+
+
+#: Marks a cached string that carries recomputation metadata
+META_MARKER = '\xfe'
+_meta_struct = struct.Struct('!dd')
+
+
 def u_(s):
     if isinstance(s, unicode):
         return s
@@ -26,3 +35,62 @@ def generate_key_for_cached_func(key_prefix, func, *args, **kwargs):
     args = map(lambda arg: u_(arg), args)
     # join them together
     return u' '.join(key_prefix + [module_name, func_name] + args + kwargs)
+
+
+def add_hash_tag(key, hash_tag, args, kwargs):
+    """Adds a hash tag to the cache key of a cached function, keys with the
+    same tag go to the same host if the router supports hash tags.
+    `hash_tag` is the index of the positional argument that is the tag, or
+    a function that is called with the arguments and returns the tag,
+    `None` means no tag.
+    """
+    if hash_tag is None:
+        return key
+    if callable(hash_tag):
+        tag = hash_tag(*args, **kwargs)
+    else:
+        tag = args[hash_tag]
+    return u'{%s} %s' % (u_(tag), key)
+
+
+def make_arg_getter(func, index, has_self=False):
+    """Returns a function that is called with the arguments of `func`, not
+    including `self` or `cls` if `has_self` is true, and returns the
+    positional argument at `index`, also if it is passed as keyword argument
+    or left at its default.
+    """
+    argspec = inspect.getargspec(func)
+    names = argspec.args[1:] if has_self else argspec.args
+    name = names[index] if index < len(names) else None
+    defaults = dict(zip(reversed(argspec.args),
+                        reversed(argspec.defaults or ())))
+
+    def getter(*args, **kwargs):
+        if index < len(args):
+            return args[index]
+        if name in kwargs:
+            return kwargs[name]
+        if name in defaults:
+            return defaults[name]
+        raise TypeError('%s() is called without the argument %s'
+                        % (func.__name__, name or index))
+    return getter
+
+
+def pack_meta(string, delta, expiry):
+    """Adds recomputation metadata to a serialized string.  `delta` is how
+    long it took to compute the value, `expiry` is the timestamp after which
+    the value should be recomputed.
+    """
+    return META_MARKER + _meta_struct.pack(delta, expiry) + string
+
+
+def unpack_meta(string):
+    """Returns a tuple of the serialized string, delta and expiry.  Delta
+    and expiry are `None` if the string carries no metadata.
+    """
+    if string is None or not string.startswith(META_MARKER) or \
+            len(string) <= _meta_struct.size:
+        return string, None, None
+    delta, expiry = _meta_struct.unpack_from(string, 1)
+    return string[1 + _meta_struct.size:], delta, expiry
@@ -7,6 +7,7 @@ import shutil
 from subprocess import Popen, PIPE
 
 import pytest
+from redis import StrictRedis
 
 
 devnull = open(os.devnull, 'w')
@@ -45,6 +46,98 @@ class RedisServer(object):
             pass
 
 
+class RedisClusterServer(object):
+
+    def __init__(self, port, config_dir):
+        self.port = port
+        self.redis = Popen(['redis-server', '-'], stdin=PIPE, stdout=devnull,
+                           cwd=config_dir)
+        self.redis.stdin.write('''
+        port %d
+        bind 127.0.0.1
+        cluster-enabled yes
+        cluster-config-file nodes-%d.conf
+        save ""''' % (port, port))
+        self.redis.stdin.flush()
+        self.redis.stdin.close()
+        while 1:
+            try:
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.connect(('127.0.0.1', port))
+            except IOError:
+                time.sleep(0.05)
+                continue
+            else:
+                s.close()
+                break
+
+    def shutdown(self):
+        self.redis.kill()
+        self.redis.wait()
+
+    def __del__(self):
+        try:
+            self.shutdown()
+        except:
+            pass
+
+
+def get_cluster_port():
+    """Returns a free port whose cluster bus port is free too."""
+    while 1:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        if port + 10000 > 65535:
+            continue
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind(('127.0.0.1', port + 10000))
+        except IOError:
+            continue
+        finally:
+            s.close()
+        return port
+
+
+@pytest.fixture(scope='session')
+def redis_cluster_hosts(request):
+    """Three redis servers in cluster mode, every one serves a third of
+    the slots.
+    """
+    config_dir = tempfile.mkdtemp()
+    servers = []
+    clients = []
+    for i in range(3):
+        server = RedisClusterServer(get_cluster_port(), config_dir)
+        servers.append(server)
+        clients.append(StrictRedis(port=server.port))
+
+    def fin():
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(config_dir)
+    request.addfinalizer(fin)
+
+    slot_ranges = [(0, 5460), (5461, 10922), (10923, 16383)]
+    for client, (start, end) in zip(clients, slot_ranges):
+        client.execute_command('CLUSTER ADDSLOTS', *range(start, end + 1))
+    for server in servers[1:]:
+        clients[0].execute_command('CLUSTER MEET', '127.0.0.1', server.port)
+    deadline = time.time() + 30
+    while not all(
+            len(client.execute_command('CLUSTER SLOTS')) == 3 and
+            client.execute_command('CLUSTER INFO')['cluster_state'] == 'ok'
+            for client in clients):
+        if time.time() > deadline:
+            raise RuntimeError('The redis cluster did not come up.')
+        time.sleep(0.05)
+    return dict(('cluster-node-%s' % i, {'host': '127.0.0.1',
+                                         'port': server.port})
+                for i, server in enumerate(servers))
+
+
 @pytest.fixture(scope='session')
 def redis_hosts(request):
     socket_dir = tempfile.mkdtemp()
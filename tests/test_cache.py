@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
+import bz2
+import time
+import threading
+
 import pytest
+from redis import StrictRedis
+from redis.connection import Connection
 
-from rc.cache import Cache, CacheCluster
+from rc.cache import BaseCache, Cache, CacheCluster, NORMAL_MODE
 from rc.testing import NullCache, FakeRedisCache
+from rc.local_cache import LocalCache
+from rc.utils import unpack_meta
+from rc.compressor import supported_compressors, ZlibCompressor
+from rc.compressor import BaseCompressor
+from rc.serializer import BaseSerializer, MsgpackSerializer
 
 
 def test_null_cache():
@@ -211,6 +222,63 @@ def test_cache_batch_mode(redis_unix_socket_path):
         assert cache_batch_test_func(i) == i
 
 
+def test_cache_batch_mode_threads(redis_unix_socket_path):
+    cache = Cache(redis_options={'unix_socket_path': redis_unix_socket_path})
+
+    @cache.cache()
+    def thread_batch_test_func(value):
+        return value
+
+    entered = threading.Event()
+    results = []
+
+    def run():
+        with cache.batch_mode():
+            rv = thread_batch_test_func('thread')
+            entered.set()
+        results.append(rv.value)
+
+    with cache.batch_mode():
+        rv = thread_batch_test_func('main')
+        t = threading.Thread(target=run)
+        t.start()
+        entered.wait()
+        t.join()
+        assert results == ['thread']
+        assert rv.is_pending
+    assert rv.value == 'main'
+
+    t = threading.Thread(target=lambda: results.append(
+        thread_batch_test_func('normal')))
+    with cache.batch_mode():
+        t.start()
+        t.join()
+    assert results == ['thread', 'normal']
+
+
+def test_cache_nested_batch_mode(redis_unix_socket_path):
+    cache = Cache(redis_options={'unix_socket_path': redis_unix_socket_path})
+
+    @cache.cache()
+    def inner_func(value):
+        return value
+
+    @cache.cache()
+    def outer_func(value):
+        return inner_func(value) * 2
+
+    with cache.batch_mode():
+        outer = outer_func(1)
+        with cache.batch_mode():
+            inner = outer_func(2)
+        assert inner.value == 4
+        assert outer.is_pending
+        assert inner_func(3).is_pending
+    assert outer.value == 2
+    assert inner_func(2) == 2
+    assert cache._running_mode == NORMAL_MODE
+
+
 def test_cache_cluster_batch_mode(redis_hosts):
     cache = CacheCluster(redis_hosts)
 
@@ -251,3 +319,475 @@ def test_cache_bypass_values(redis_unix_socket_path):
         return 1
 
     assert bypass_values_test_func() is not None
+
+
+def test_cache_local_cache(redis_unix_socket_path):
+    local_cache = LocalCache()
+    cache = Cache(redis_options={'unix_socket_path': redis_unix_socket_path},
+                  namespace='local:', local_cache=local_cache)
+    remote_cache = Cache(
+        namespace='local:',
+        redis_options={'unix_socket_path': redis_unix_socket_path})
+    assert cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+    assert remote_cache.set('key', 'changed')
+    assert cache.get('key') == 'value'
+    assert cache.get_many('key', 'key2') == ['value', None]
+    assert cache.delete('key')
+    assert cache.get('key') is None
+    assert cache.set_many({'key1': 'value1', 'key2': 'value2'})
+    assert cache.get_many('key1', 'key2') == ['value1', 'value2']
+    assert remote_cache.delete_many('key1')
+    assert cache.get_many('key1', 'key2') == ['value1', 'value2']
+    assert cache.delete_many('key1', 'key2')
+    assert cache.get_many('key1', 'key2') == [None, None]
+
+    calls = []
+
+    @cache.cache()
+    def local_cache_test_func(value):
+        calls.append(value)
+        return value
+    assert local_cache_test_func(1) == 1
+    remote_cache.client.delete(*remote_cache.client.keys('local:*'))
+    assert local_cache_test_func(1) == 1
+    assert calls == [1]
+    with cache.batch_mode():
+        promises = [local_cache_test_func(1), local_cache_test_func(2)]
+    assert [p.value for p in promises] == [1, 2]
+    assert calls == [1, 2]
+    assert cache.invalidate(local_cache_test_func, 2)
+    assert local_cache_test_func(2) == 2
+    assert calls == [1, 2, 2]
+
+    # caches with other namespaces can share the local cache
+    other_cache = Cache(
+        redis_options={'unix_socket_path': redis_unix_socket_path},
+        namespace='other:', local_cache=local_cache)
+    assert cache.set('key', 'value')
+    assert other_cache.set('key', 'other')
+    assert cache.get('key') == 'value'
+    assert other_cache.get('key') == 'other'
+    assert cache.delete('key')
+    assert other_cache.get_many('key') == ['other']
+    assert other_cache.delete('key')
+
+    # local values expire with their keys in redis
+    assert remote_cache.set('key', 'value', expire=1)
+    assert remote_cache.set_many({'key1': 'value1'}, expire=1)
+    assert cache.get('key') == 'value'
+    assert cache.get_many('key1') == ['value1']
+    time.sleep(1.1)
+    assert cache.get('key') is None
+    assert cache.get_many('key1') == [None]
+
+
+def test_cache_single_flight(redis_unix_socket_path):
+    caches = [Cache(redis_options={'unix_socket_path': redis_unix_socket_path})
+              for i in range(2)]
+    calls = []
+
+    def single_flight_test_func(value):
+        calls.append(value)
+        time.sleep(0.2)
+        return value
+    funcs = [caches[0].cache(single_flight=True)(single_flight_test_func),
+             caches[0].cache(lock_timeout=2)(single_flight_test_func),
+             caches[1].cache(lock_timeout=2)(single_flight_test_func)]
+
+    def run(funcs, value):
+        results = []
+        threads = [
+            threading.Thread(target=lambda f=f: results.append(f(value)))
+            for f in funcs for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    assert run(funcs[:1], 'process') == ['process'] * 3
+    assert calls == ['process']
+    assert run(funcs[1:], 'cluster') == ['cluster'] * 6
+    assert calls == ['process', 'cluster']
+    assert caches[0].client.get('test_cache single_flight_test_func '
+                                'cluster:lock') is None
+
+
+@pytest.mark.parametrize('cache_cls', ['cache', 'cluster'])
+def test_cache_lock_token(redis_hosts, redis_unix_socket_path, cache_cls):
+    if cache_cls == 'cache':
+        cache = Cache(
+            redis_options={'unix_socket_path': redis_unix_socket_path})
+    else:
+        cache = CacheCluster(redis_hosts)
+    lock_key = 'test_cache lock_token_test_func %s:lock' % cache_cls
+    calls = []
+
+    @cache.cache(lock_timeout=2)
+    def lock_token_test_func(value):
+        calls.append(value)
+        # the lock expired and another process holds it now
+        cache.client.set(lock_key, 'other')
+        return value
+    cache.invalidate(lock_token_test_func, cache_cls)
+    assert lock_token_test_func(cache_cls) == cache_cls
+    assert cache.client.get(lock_key) == 'other'
+    cache.client.delete(lock_key)
+
+    # the result is read again after taking the lock
+    cache_key = 'test_cache lock_token_test_func %s' % cache_cls
+    params = {'lock_timeout': 2, 'recompute_beta': None}
+    assert cache.set(cache_key, 'cached')
+    rv, cached = cache._compute_value_with_lock(
+        None, lock_token_test_func, (cache_cls,), {}, cache_key, params)
+    assert cache.serializer.loads(rv) == 'cached'
+    assert cached
+    assert calls == [cache_cls]
+    assert cache.client.get(lock_key) is None
+
+
+@pytest.mark.parametrize('cache_cls', ['cache', 'cluster', 'local'])
+def test_cache_early_recompute(redis_hosts, redis_unix_socket_path,
+                               cache_cls):
+    if cache_cls == 'cache':
+        cache = Cache(
+            redis_options={'unix_socket_path': redis_unix_socket_path})
+    elif cache_cls == 'local':
+        # results in the recomputation window are not kept locally
+        cache = Cache(
+            redis_options={'unix_socket_path': redis_unix_socket_path},
+            local_cache=LocalCache())
+    else:
+        cache = CacheCluster(redis_hosts)
+    calls = []
+
+    def early_recompute_test_func(value):
+        calls.append(value)
+        time.sleep(0.01)
+        return value
+    never = cache.cache(key_prefix=cache_cls + 'never',
+                        early_recompute=True,
+                        beta=0)(early_recompute_test_func)
+    always = cache.cache(key_prefix=cache_cls + 'always',
+                         early_recompute=True,
+                         beta=1e15)(early_recompute_test_func)
+
+    assert never(1) == 1
+    assert never(1) == 1
+    assert calls == [1]
+    string, delta, expiry = unpack_meta(
+        cache.client.get(cache_cls + 'never test_cache '
+                         'early_recompute_test_func 1'))
+    assert string == '1'
+    assert delta >= 0.01
+    assert expiry > time.time() + cache.default_expire - 10
+    assert always(2) == 2
+    assert always(2) == 2
+    assert calls == [1, 2, 2]
+
+    with cache.batch_mode():
+        promises = [never(1), always(2), never(3)]
+    assert [p.value for p in promises] == [1, 2, 3]
+    assert calls == [1, 2, 2, 2, 3]
+
+
+@pytest.mark.parametrize('local_cache', [None, LocalCache()])
+def test_cache_soft_expire(redis_unix_socket_path, local_cache):
+    # local hits must not hide stale results
+    cache = Cache(redis_options={'unix_socket_path': redis_unix_socket_path},
+                  local_cache=local_cache)
+    calls = []
+
+    @cache.cache(soft_expire=0.1)
+    def soft_expire_test_func(value):
+        calls.append(value)
+        return '%s-%s' % (value, len(calls))
+    cache.invalidate(soft_expire_test_func, 1)
+
+    assert soft_expire_test_func(1) == '1-1'
+    assert soft_expire_test_func(1) == '1-1'
+    assert cache.client.ttl('test_cache soft_expire_test_func 1') > 3600
+    time.sleep(0.15)
+    assert soft_expire_test_func(1) == '1-1'
+    cache._refresh_pool.join()
+    assert soft_expire_test_func(1) == '1-2'
+
+    time.sleep(0.15)
+    with cache.batch_mode():
+        promise = soft_expire_test_func(1)
+    assert promise.value == '1-2'
+    cache._refresh_pool.join()
+    assert soft_expire_test_func(1) == '1-3'
+    assert calls == [1, 1, 1]
+
+
+@pytest.mark.parametrize('batch_workers', [1, 4])
+def test_cache_batch_mode_write_back(redis_hosts, batch_workers):
+    cache = CacheCluster(redis_hosts, batch_workers=batch_workers)
+    calls = []
+    set_many_calls = []
+    raw_set_many = cache._raw_set_many
+
+    def counting_raw_set_many(mapping, expire=None):
+        set_many_calls.append((sorted(mapping), expire))
+        return raw_set_many(mapping, expire)
+    cache._raw_set_many = counting_raw_set_many
+    cache._raw_set = None
+
+    @cache.cache(key_prefix=str(batch_workers))
+    def write_back_test_func(value):
+        calls.append(value)
+        time.sleep(0.01)
+        return value
+
+    @cache.cache(key_prefix=str(batch_workers), expire=100)
+    def write_back_expire_test_func(value):
+        return value
+
+    with cache.batch_mode():
+        promises = [write_back_test_func(i) for i in range(20)]
+        promises.append(write_back_test_func(0))
+        promises.append(write_back_expire_test_func(0))
+    assert [p.value for p in promises] == range(20) + [0, 0]
+    assert sorted(calls) == range(20)
+    assert sorted(set_many_calls) == [
+        (['%s test_cache write_back_expire_test_func 0' % batch_workers],
+         100),
+        (sorted('%s test_cache write_back_test_func %s' % (batch_workers, i)
+                for i in range(20)), None),
+    ]
+    with cache.batch_mode():
+        promises = [write_back_test_func(i) for i in range(20)]
+    assert [p.value for p in promises] == range(20)
+    assert len(calls) == 20
+
+
+@pytest.mark.parametrize('batch_workers', [1, 4])
+def test_cache_many(redis_hosts, batch_workers):
+    cache = CacheCluster(redis_hosts, batch_workers=batch_workers)
+    calls = []
+
+    @cache.cache_many(key_prefix=str(batch_workers))
+    def cache_many_test_func(ids):
+        calls.append(sorted(ids))
+        return dict((id, 'value-%s' % id) for id in ids if id != 0)
+
+    assert cache_many_test_func([]) == {}
+    assert cache_many_test_func([1, 2]) == {1: 'value-1', 2: 'value-2'}
+    assert cache_many_test_func([2, 3, 0]) == {
+        0: None, 2: 'value-2', 3: 'value-3'}
+    assert calls == [[1, 2], [0, 3]]
+    assert cache.invalidate(cache_many_test_func, 2)
+    with cache.batch_mode():
+        p1 = cache_many_test_func([1, 2, 4])
+        p2 = cache_many_test_func([4, 5, 0])
+        p3 = cache_many_test_func([])
+    assert p1.value == {1: 'value-1', 2: 'value-2', 4: 'value-4'}
+    assert p2.value == {0: None, 4: 'value-4', 5: 'value-5'}
+    assert p3.value == {}
+    assert calls == [[1, 2], [0, 3], [2, 4, 5]]
+
+    class Post(object):
+        @cache.cache_many(key_prefix=str(batch_workers))
+        def load(self, ids):
+            return dict((id, id) for id in ids)
+    assert Post().load([1, 2]) == {1: 1, 2: 2}
+
+    # other arguments can be lists too
+    @cache.cache_many(key_prefix=str(batch_workers))
+    def load_fields(fields, ids):
+        calls.append((fields, sorted(ids)))
+        return dict((id, [id] + fields) for id in ids)
+    assert load_fields(['a'], [1, 2]) == {1: [1, 'a'], 2: [2, 'a']}
+    del calls[:]
+    with cache.batch_mode():
+        p1 = load_fields(['a'], [2, 3])
+        p2 = load_fields(['a'], [4])
+        p3 = load_fields(['b'], [1])
+    assert p1.value == {2: [2, 'a'], 3: [3, 'a']}
+    assert p2.value == {4: [4, 'a']}
+    assert p3.value == {1: [1, 'b']}
+    assert sorted(calls) == [(['a'], [3, 4]), (['b'], [1])]
+
+
+@pytest.mark.parametrize('compressor_cls', supported_compressors)
+def test_cache_compressor(redis_hosts, compressor_cls):
+    cache = CacheCluster(redis_hosts, namespace='compressor:',
+                         compressor_cls=compressor_cls,
+                         compressor_options={'min_length': 10})
+    # reads compressed values but never writes them
+    plain_cache = CacheCluster(redis_hosts, namespace='compressor:',
+                               compressor_cls=ZlibCompressor,
+                               compressor_options={'min_length': 1 << 30})
+    value = 'value' * 100
+    assert cache.set('key', value)
+    assert plain_cache.client.get('compressor:key')[0] == \
+        compressor_cls.marker
+    assert cache.get('key') == value
+    assert plain_cache.get('key') == value
+    assert plain_cache.set('key2', value)
+    assert plain_cache.client.get('compressor:key2') == '"%s"' % value
+    assert cache.get_many('key', 'key2') == [value, value]
+    assert cache.set_many({'key': 'value', 'key2': value})
+    assert plain_cache.client.get('compressor:key') == '"value"'
+    assert plain_cache.get_many('key', 'key2') == ['value', value]
+
+    @cache.cache(key_prefix=compressor_cls.__name__, early_recompute=True)
+    def compressor_test_func(i):
+        return value * i
+    assert compressor_test_func(1) == value
+    assert compressor_test_func(1) == value
+    with cache.batch_mode():
+        promises = [compressor_test_func(i) for i in range(3)]
+    assert [p.value for p in promises] == [value * i for i in range(3)]
+    with cache.batch_mode():
+        promises = [compressor_test_func(i) for i in range(3)]
+    assert [p.value for p in promises] == [value * i for i in range(3)]
+
+
+class BZ2Compressor(BaseCompressor):
+    is_supported = True
+    marker = '\xf4'
+
+    def compress_data(self, data):
+        return bz2.compress(data)
+
+    def decompress_data(self, data):
+        return bz2.decompress(data)
+
+
+def test_cache_custom_compressor(redis_unix_socket_path):
+    cache = Cache(redis_options={'unix_socket_path': redis_unix_socket_path},
+                  namespace='bz2:', compressor_cls=BZ2Compressor,
+                  compressor_options={'min_length': 10})
+    value = 'value' * 100
+    assert cache.set('key', value)
+    assert cache.client.get('bz2:key')[0] == BZ2Compressor.marker
+    assert cache.get('key') == value
+    assert cache.get_many('key', 'missing') == [value, None]
+
+    @cache.cache()
+    def bz2_test_func():
+        return value
+    assert bz2_test_func() == value
+    assert bz2_test_func() == value
+    with cache.batch_mode():
+        promise = bz2_test_func()
+    assert promise.value == value
+
+
+class MarkerSerializer(BaseSerializer):
+    """Writes strings that start with the marker of zlib."""
+
+    def dumps(self, obj):
+        return '\xf1' + obj
+
+    def loads(self, string):
+        if string is not None:
+            return string[1:]
+
+
+def test_cache_without_compressor(redis_unix_socket_path):
+    cache = Cache(redis_options={'unix_socket_path': redis_unix_socket_path},
+                  namespace='marker:', serializer_cls=MarkerSerializer)
+    assert cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+    assert cache.get_many('key') == ['value']
+
+
+def test_cache_msgpack_serializer(redis_unix_socket_path):
+    cache = Cache(redis_options={'unix_socket_path': redis_unix_socket_path},
+                  serializer_cls=MsgpackSerializer,
+                  compressor_cls=ZlibCompressor)
+    for value in [-2, -15, u'value', [1, 2]]:
+        assert cache.set('key', value)
+        assert cache.get('key') == value
+        assert cache.get_many('key') == [value]
+
+    @cache.cache(early_recompute=True)
+    def msgpack_test_func(value):
+        return value
+    assert msgpack_test_func(-2) == -2
+    assert msgpack_test_func(-2) == -2
+
+
+def test_base_cache_pipelines(redis_unix_socket_path, monkeypatch):
+    class PlainCache(BaseCache):
+        def get_client(self):
+            return StrictRedis(unix_socket_path=redis_unix_socket_path)
+    cache = PlainCache(namespace='pipelines:')
+    round_trips = []
+    send_packed_command = Connection.send_packed_command
+
+    def counting_send_packed_command(self, command):
+        round_trips.append(command)
+        return send_packed_command(self, command)
+    monkeypatch.setattr(Connection, 'send_packed_command',
+                        counting_send_packed_command)
+
+    mapping = dict(('key%s' % i, i) for i in range(10))
+    assert cache.set_many(mapping)
+    assert len(round_trips) == 1
+    assert cache.get_many(*sorted(mapping)) == \
+        [mapping[key] for key in sorted(mapping)]
+    assert len(round_trips) == 2
+    assert cache.delete_many(*mapping)
+    assert len(round_trips) == 3
+    assert not cache.delete_many('key0', 'key1')
+    assert cache.get_many('key0', 'key1') == [None, None]
+
+
+def test_cache_hash_tag(redis_hosts):
+    cache = CacheCluster(redis_hosts, router_options={'hash_tags': True})
+    calls = []
+
+    @cache.cache(hash_tag=0)
+    def get_profile(user_id, field):
+        calls.append(field)
+        return '%s:%s' % (user_id, field)
+
+    @cache.cache(hash_tag=lambda user_id: user_id)
+    def get_settings(user_id):
+        return {'theme': 'dark'}
+
+    class Users(object):
+
+        @cache.cache_many(hash_tag=0)
+        def get_counters(self, user_ids):
+            return dict((user_id, user_id * 10) for user_id in user_ids)
+
+    assert get_profile(42, 'name') == '42:name'
+    assert get_profile(42, 'email') == '42:email'
+    assert get_settings(42) == {'theme': 'dark'}
+    assert Users().get_counters([42, 43]) == {42: 420, 43: 430}
+
+    # all results of user 42 are on the host of its tag
+    router = cache.client.connection_pool.cluster.router
+    tag_host_name = router.get_host_for_key('42')
+    for host_name, host_config in redis_hosts.iteritems():
+        client = StrictRedis(**host_config)
+        tagged_keys = client.keys('{42}*')
+        if host_name == tag_host_name:
+            assert len(tagged_keys) == 4
+        else:
+            assert tagged_keys == []
+
+    assert get_profile(42, 'name') == '42:name'
+    assert calls == ['name', 'email']
+    assert cache.invalidate(get_profile, 42, 'name')
+    assert cache.invalidate(get_settings, 42)
+    assert cache.invalidate(Users().get_counters, 43)
+    assert get_profile(42, 'name') == '42:name'
+    assert calls == ['name', 'email', 'name']
+
+    # the tag is found when it is passed as keyword argument or left out
+    @cache.cache(hash_tag=1)
+    def get_avatar(size, user_id=7):
+        return '%s:%s' % (user_id, size)
+    assert get_avatar(16, user_id=43) == '43:16'
+    assert get_avatar(16) == '7:16'
+    assert cache.client.get(u'{43} test_cache get_avatar 16 user_id=43')
+    assert cache.client.get(u'{7} test_cache get_avatar 16')
+    assert cache.invalidate(get_avatar, 16, user_id=43)
+    assert cache.invalidate(get_avatar, 16)
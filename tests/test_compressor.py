@@ -0,0 +1,24 @@
+import pytest
+
+from rc.compressor import supported_compressors, decompress
+
+
+@pytest.mark.parametrize('compressor_cls', supported_compressors)
+def test_compressor(compressor_cls):
+    compressor = compressor_cls(min_length=10)
+    string = '"%s"' % ('value' * 100)
+    compressed = compressor.compress(string)
+    assert compressed[0] == compressor.marker
+    assert len(compressed) < len(string)
+    assert compressor.decompress(compressed) == string
+    assert decompress(compressed) == string
+    assert compressor.compress('"value"') == '"value"'
+    assert compressor.compress('"%s"' % ''.join(
+        chr(i) for i in range(35, 126))) == '"%s"' % ''.join(
+        chr(i) for i in range(35, 126))
+
+
+def test_decompress():
+    assert decompress(None) is None
+    assert decompress('') == ''
+    assert decompress('"value"') == '"value"'
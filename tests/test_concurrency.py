@@ -0,0 +1,64 @@
+import time
+import threading
+
+import pytest
+
+from rc.concurrency import SingleFlight, WorkerPool
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+
+    def load(value):
+        calls.append(value)
+        time.sleep(0.1)
+        return value
+
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(flight.do('key', load, 'value')))
+        for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert calls == ['value']
+    assert results == ['value'] * 5
+    assert flight.do('key', load, 'value') == 'value'
+    assert calls == ['value', 'value']
+
+    def error():
+        raise ValueError()
+    with pytest.raises(ValueError):
+        flight.do('key', error)
+
+
+def test_worker_pool():
+    pool = WorkerPool(max_workers=2, max_pending=2)
+    event = threading.Event()
+    calls = []
+
+    def job(value):
+        event.wait()
+        calls.append(value)
+
+    assert pool.submit('key1', job, 1)
+    assert not pool.submit('key1', job, 1)
+    assert pool.submit('key2', job, 2)
+    time.sleep(0.05)
+    assert pool.submit('key3', job, 3)
+    assert pool.submit('key4', job, 4)
+    assert not pool.submit('key5', job, 5)
+    event.set()
+    pool.join()
+    assert sorted(calls) == [1, 2, 3, 4]
+    assert len(pool._workers) == 2
+
+    def error():
+        raise ValueError()
+    assert pool.submit('key1', error)
+    pool.join()
+    assert pool.submit('key1', job, 1)
+    pool.join()
+    assert sorted(calls) == [1, 1, 2, 3, 4]
@@ -1,4 +1,41 @@
-from rc.ketama import HashRing
+import math
+from bisect import bisect
+
+from rc.ketama import HashRing, md5_bytes
+
+
+class ListHashRing(object):
+    """The ring as it was kept before it was backed by arrays, every node
+    must stay where it was.
+    """
+
+    def __init__(self, nodes, weights=None):
+        weights = weights or {}
+        nodes = set(nodes)
+        total_weight = sum(weights.get(node, 1) for node in nodes)
+        self._hashring = {}
+        self._sorted_keys = []
+        for node in nodes:
+            weight = weights.get(node, 1)
+            ks = math.floor((40 * len(nodes) * weight) / total_weight)
+            for i in xrange(0, int(ks)):
+                k = md5_bytes('%s-%s-salt' % (node, i))
+                for l in xrange(0, 4):
+                    key = ((k[3 + l * 4] << 24) | (k[2 + l * 4] << 16) |
+                           (k[1 + l * 4] << 8) | k[l * 4])
+                    self._hashring[key] = node
+                    self._sorted_keys.append(key)
+        self._sorted_keys.sort()
+
+    def get_node(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        k = md5_bytes(key)
+        key = (k[3] << 24) | (k[2] << 16) | (k[1] << 8) | k[0]
+        pos = bisect(self._sorted_keys, key)
+        if pos == len(self._sorted_keys):
+            pos = 0
+        return self._hashring[self._sorted_keys[pos]]
 
 
 def test_basic():
@@ -13,3 +50,46 @@ def test_basic():
     keys_nodes = [hashring.get_node(k) for k in keys]
     for node in nodes:
         assert node in keys_nodes
+
+
+def test_get_nodes():
+    nodes = ['node%02d' % i for i in range(10)]
+    weights = {'node01': 3, 'node02': 2}
+    keys = ['key-%s' % i for i in range(2000)] + [u'k\xe9y']
+    for ring_weights in (None, weights):
+        hashring = HashRing(nodes, ring_weights)
+        list_hashring = ListHashRing(nodes, ring_weights)
+        expected = [list_hashring.get_node(k) for k in keys]
+        assert [hashring.get_node(k) for k in keys] == expected
+        assert hashring.get_nodes(keys) == expected
+    assert HashRing().get_node('key') is None
+    assert HashRing().get_nodes(['key']) == [None]
+
+
+def test_add_and_remove_nodes():
+    nodes = ['node%02d' % i for i in range(8)]
+    keys = ['key-%s' % i for i in range(2000)]
+    hashring = HashRing(nodes[:6])
+    before = hashring.get_nodes(keys)
+
+    hashring.add_node(nodes[6])
+    after = hashring.get_nodes(keys)
+    assert after == HashRing(nodes[:7]).get_nodes(keys)
+    for old_node, new_node in zip(before, after):
+        assert new_node in (old_node, nodes[6])
+
+    hashring.add_node(nodes[7], 2)
+    assert hashring.get_nodes(keys) == \
+        HashRing(nodes, {nodes[7]: 2}).get_nodes(keys)
+
+    hashring.add_node(nodes[7], 1)
+    hashring.remove_node(nodes[6])
+    hashring.remove_node('missing')
+    assert hashring.get_nodes(keys) == \
+        HashRing(nodes[:6] + nodes[7:]).get_nodes(keys)
+
+    for node in nodes:
+        hashring.remove_node(node)
+    assert hashring.get_node('key') is None
+    hashring.add_node(nodes[0])
+    assert set(hashring.get_nodes(keys)) == set([nodes[0]])
@@ -0,0 +1,53 @@
+import time
+
+from rc.local_cache import LocalCache
+
+
+def test_local_cache_basic_apis():
+    local_cache = LocalCache()
+    assert local_cache.get('key') is None
+    assert local_cache.get('key', 'default') == 'default'
+    local_cache.set('key', 'value', 5)
+    assert local_cache.get('key') == 'value'
+    local_cache.set('key', None, 4)
+    assert local_cache.get('key', 'default') is None
+    local_cache.delete('key')
+    assert local_cache.get('key') is None
+    local_cache.set('key1', 'value1')
+    local_cache.set('key2', 'value2')
+    local_cache.delete_many(['key1', 'key2'])
+    assert len(local_cache) == 0
+    local_cache.set('key', 'value')
+    local_cache.clear()
+    assert local_cache.get('key') is None
+
+
+def test_local_cache_limits():
+    local_cache = LocalCache(max_entries=2)
+    local_cache.set('key1', 'value1')
+    local_cache.set('key2', 'value2')
+    assert local_cache.get('key1') == 'value1'
+    local_cache.set('key3', 'value3')
+    assert local_cache.get('key2') is None
+    assert local_cache.get('key1') == 'value1'
+    assert local_cache.get('key3') == 'value3'
+
+    local_cache = LocalCache(max_bytes=10)
+    local_cache.set('key1', 'value1', 6)
+    local_cache.set('key2', 'value2', 6)
+    assert local_cache.get('key1') is None
+    assert local_cache.get('key2') == 'value2'
+    local_cache.set('key3', 'value3', 11)
+    assert local_cache.get('key3') is None
+    assert local_cache.get('key2') == 'value2'
+
+
+def test_local_cache_expire():
+    local_cache = LocalCache(max_expire=0.05)
+    local_cache.set('key1', 'value1', expire=3600)
+    local_cache.set('key2', 'value2', expire=0)
+    assert local_cache.get('key1') == 'value1'
+    assert local_cache.get('key2') is None
+    time.sleep(0.06)
+    assert local_cache.get('key1') is None
+    assert len(local_cache) == 0
@@ -1,6 +1,11 @@
+import gc
+import time
+import socket
+import threading
+
 import pytest
 
-from rc.poller import supported_pollers
+from rc.poller import supported_pollers, SelectPoller
 from rc import redis_clients
 from rc.redis_cluster import RedisCluster
 
@@ -18,3 +23,144 @@ def test_all_pollers(redis_hosts, poller, monkeypatch):
         keys.append(key)
         cluster_client.set(key, i)
     assert cluster_client.mget(keys) == map(str, range(10))
+    bufs_poll = cluster_client._get_poller()
+    assert isinstance(bufs_poll, poller)
+    assert len(bufs_poll) == 0
+    assert cluster_client.mget(keys) == map(str, range(10))
+    assert cluster_client._get_poller() is bufs_poll
+    cluster_client.close()
+    assert bufs_poll.closed
+    assert cluster_client.mget(keys) == map(str, range(10))
+    assert cluster_client._get_poller() is not bufs_poll
+
+
+@pytest.mark.parametrize('poller', supported_pollers)
+def test_poller_register(poller):
+    a, b = socket.socketpair()
+    c, d = socket.socketpair()
+    bufs_poll = poller()
+    bufs_poll.register('a', a)
+    bufs_poll.register('c', c)
+    assert len(bufs_poll) == 2
+    rlist, wlist = bufs_poll.poll(1.0)
+    assert rlist == []
+    assert sorted(wlist) == sorted([a, c])
+
+    b.send('x')
+    assert bufs_poll.unregister('c') is c
+    assert bufs_poll.unregister('c') is None
+    rlist, wlist = bufs_poll.poll(1.0)
+    # readable sockets are reported as writable too
+    assert rlist == [a]
+    assert wlist == [a]
+
+    # closed sockets can be unregistered
+    a.close()
+    bufs_poll.clear()
+    assert len(bufs_poll) == 0
+    bufs_poll.register('c', c)
+    rlist, wlist = bufs_poll.poll(1.0)
+    assert wlist == [c]
+    bufs_poll.close()
+    assert bufs_poll.closed
+    assert len(bufs_poll) == 0
+    for s in (b, c, d):
+        s.close()
+
+
+@pytest.mark.parametrize('poller', supported_pollers)
+def test_poller_writable(poller):
+    a, b = socket.socketpair()
+    bufs_poll = poller()
+    bufs_poll.register('a', a, writable=False)
+    assert bufs_poll.poll(0.01) == ([], [])
+    bufs_poll.set_writable('a', True)
+    assert bufs_poll.poll(1.0) == ([], [a])
+    bufs_poll.set_writable('a', False)
+    b.send('x')
+    assert bufs_poll.poll(1.0) == ([a], [])
+    bufs_poll.close()
+    a.close()
+    b.close()
+
+
+@pytest.mark.parametrize('poller', [poller for poller in supported_pollers
+                                    if poller is not SelectPoller])
+def test_poller_keeps_registrations(poller, monkeypatch):
+    registered_fds = []
+    register_fd = poller._register_fd
+
+    def recording_register_fd(self, fd, writable):
+        registered_fds.append(fd)
+        register_fd(self, fd, writable)
+    monkeypatch.setattr(poller, '_register_fd', recording_register_fd)
+    a, b = socket.socketpair()
+    bufs_poll = poller()
+    for _ in range(3):
+        bufs_poll.register('a', a, writable=False)
+        assert bufs_poll.poll(0.01) == ([], [])
+        bufs_poll.unregister('a')
+    assert registered_fds == [a.fileno()]
+
+    # the registration of another socket with the same fd is replaced
+    fd = a.fileno()
+    a.close()
+    c, d = socket.socketpair()
+    assert fd in (c.fileno(), d.fileno())
+    for s in (c, d):
+        bufs_poll.register(s.fileno(), s)
+    assert sorted(bufs_poll.poll(1.0)[1]) == sorted([c, d])
+    assert registered_fds == [fd, c.fileno(), d.fileno()]
+
+    # idle sockets that are reported are dropped
+    bufs_poll.clear()
+    d.send('x')
+    assert bufs_poll.poll(0.01) == ([], [])
+    assert c.fileno() not in bufs_poll.fd_registrations
+    bufs_poll.close()
+    for s in (b, c, d):
+        s.close()
+
+
+@pytest.mark.parametrize('poller', [poller for poller in supported_pollers
+                                    if poller is not SelectPoller])
+def test_cluster_client_keeps_registrations(redis_hosts, poller,
+                                            monkeypatch):
+    monkeypatch.setattr(redis_clients, 'poller', poller)
+    registered_fds = []
+    register_fd = poller._register_fd
+
+    def recording_register_fd(self, fd, writable):
+        registered_fds.append(fd)
+        register_fd(self, fd, writable)
+    monkeypatch.setattr(poller, '_register_fd', recording_register_fd)
+    cluster_client = RedisCluster(redis_hosts).get_client()
+    keys = ['key-%s' % i for i in range(10)]
+    cluster_client.mget(keys)
+    fds = list(registered_fds)
+    assert fds
+    cluster_client.mget(keys)
+    cluster_client.mget(keys)
+    assert registered_fds == fds
+    cluster_client.close()
+
+
+def test_pollers_of_finished_threads(redis_hosts):
+    cluster_client = RedisCluster(redis_hosts).get_client()
+    keys = ['key-%s' % i for i in range(10)]
+    cluster_client.mget(keys)
+    bufs_poll = cluster_client._get_poller()
+
+    def worker():
+        cluster_client.mget(keys)
+    threads = [threading.Thread(target=worker) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # python drops the thread locals shortly after join returns
+    deadline = time.time() + 5
+    while len(cluster_client._pollers) > 1 and time.time() < deadline:
+        gc.collect()
+        time.sleep(0.01)
+    assert list(cluster_client._pollers) == [bufs_poll]
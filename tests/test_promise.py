@@ -23,3 +23,14 @@ def test_promise_then():
     p.resolve('value')
     assert v.value == 'value'
     assert d['key'] == 'value'
+
+
+def test_promise_all():
+    p1, p2 = Promise(), Promise()
+    p = Promise.all([p1, p2])
+    p1.resolve('value1')
+    assert p.is_pending
+    p2.resolve('value2')
+    assert p.value == ['value1', 'value2']
+    assert Promise.all([]).value == []
+    assert Promise.all([p1]).value == ['value1']
@@ -1,4 +1,14 @@
+import socket
+
+import pytest
+
+from redis import StrictRedis
+from redis.connection import Connection
+from redis.exceptions import ResponseError
+
+from rc import redis_clients
 from rc.redis_cluster import RedisCluster
+from rc.redis_router import RedisClusterSlotRouter
 
 
 def test_redis_cluster_client_basic_operations(redis_hosts):
@@ -59,3 +69,237 @@ def test_redis_cluster_client_basic_operations(redis_hosts):
     for key in deleted_keys:
         assert client.get(key) is None
     assert client.mget(keys) == [None] * 5 + map(str, range(35, 40))
+
+
+@pytest.mark.skipif(not redis_clients.MSG_DONTWAIT,
+                    reason='MSG_DONTWAIT is not supported')
+def test_redis_cluster_client_sends_without_blocking(redis_hosts,
+                                                     monkeypatch):
+    cluster = RedisCluster(redis_hosts)
+    client = cluster.get_client()
+    mode_switches = []
+    setblocking = socket._socketobject.setblocking
+
+    def counting_setblocking(self, flag):
+        mode_switches.append(flag)
+        return setblocking(self, flag)
+    monkeypatch.setattr(socket._socketobject, 'setblocking',
+                        counting_setblocking)
+
+    # big values do not fit into the socket buffers with one send
+    value = 'x' * 1024 * 1024
+    mapping = dict(('big key: %s' % i, value) for i in xrange(8))
+    assert client.msetex(mapping, 100)
+    assert client.mget(sorted(mapping)) == [value] * 8
+    assert client.mdelete(*mapping) == 8
+    assert mode_switches == []
+
+    # sockets with a timeout would wait for the timeout with MSG_DONTWAIT
+    cluster = RedisCluster(redis_hosts, pool_options={'socket_timeout': 5})
+    client = cluster.get_client()
+    assert client.msetex(mapping, 100)
+    assert client.mdelete(*mapping) == 8
+    assert False in mode_switches
+
+
+def test_redis_cluster_client_concurrency(redis_hosts, monkeypatch):
+    cluster = RedisCluster(redis_hosts)
+    client = cluster.get_client(max_concurrency=3,
+                                max_concurrency_per_server=1)
+    bufs_poll = client._get_poller()
+    loads = []
+    register = bufs_poll.register
+
+    def recording_register(key, obj, writable=True):
+        register(key, obj, writable)
+        servers = [buf.server for buf in bufs_poll.objects.values()]
+        loads.append(len(servers))
+        assert len(set(servers)) == len(servers)
+    monkeypatch.setattr(bufs_poll, 'register', recording_register)
+
+    keys = ['concurrency key: %s' % i for i in xrange(100)]
+    client.msetex(dict((key, key) for key in keys), 100)
+    assert client.mget(keys) == keys
+    assert len(loads) == 2 * len(redis_hosts)
+    assert max(loads) == 3
+
+
+def test_redis_cluster_client_max_keys_per_command(redis_hosts, monkeypatch):
+    cluster = RedisCluster(redis_hosts)
+    client = cluster.get_client(max_keys_per_command=3)
+    sent_commands = []
+    pack_commands = Connection.pack_commands
+
+    def recording_pack_commands(self, commands):
+        sent_commands.extend(commands)
+        return pack_commands(self, commands)
+    monkeypatch.setattr(Connection, 'pack_commands', recording_pack_commands)
+
+    keys = ['chunk key: %s' % i for i in xrange(200)]
+    assert client.msetex(dict((key, key) for key in keys), 100)
+    del sent_commands[:]
+    assert client.mget(keys + ['missing chunk key']) == keys + [None]
+    assert max(len(command) for command in sent_commands) == 4
+    assert sum(len(command) - 1 for command in sent_commands) == 201
+    assert client.mdelete(*keys) == 200
+    assert client.mget(keys) == [None] * 200
+
+
+def test_redis_cluster_client_pipeline(redis_hosts):
+    cluster = RedisCluster(redis_hosts)
+    client = cluster.get_client()
+
+    counters = ['pipeline counter: %s' % i for i in xrange(20)]
+    client.mdelete(*counters)
+    with client.pipeline() as pipe:
+        for counter in counters:
+            pipe.incr(counter).expire(counter, 100)
+        pipe.hset('pipeline hash', 'field', 'value')
+        pipe.hget('pipeline hash', 'field')
+        pipe.zadd('pipeline zset', 1.5, 'member')
+        pipe.zrange('pipeline zset', 0, -1, withscores=True)
+        assert len(pipe) == 44
+        results = pipe.execute()
+    assert results[:40] == [1, True] * 20
+    assert results[41:] == ['value', 1, [('member', 1.5)]]
+    assert pipe.execute() == []
+    assert client.mget(counters) == ['1'] * 20
+
+    pipe = client.pipeline()
+    pipe.incr(counters[0]).hget(counters[1], 'field').incr(counters[2])
+    with pytest.raises(ResponseError):
+        pipe.execute()
+    assert client.get(counters[2]) == '2'
+    pipe.incr(counters[0]).hget(counters[1], 'field')
+    rv = pipe.execute(raise_on_error=False)
+    assert rv[0] == 3
+    assert isinstance(rv[1], ResponseError)
+
+    with pytest.raises(RuntimeError):
+        client.pipeline(transaction=True)
+
+
+def test_redis_cluster_client_split_commands(redis_hosts):
+    cluster = RedisCluster(redis_hosts)
+    client = cluster.get_client()
+
+    keys = ['split key: %s' % i for i in xrange(20)]
+    assert client.mset(dict((key, key) for key in keys))
+    assert client.execute_command('MGET', *keys) == keys
+    assert client.execute_command('EXISTS', *keys)
+    assert not client.execute_command('EXISTS', 'missing', 'missing 2')
+    assert client.delete(*keys[:10]) == 10
+    assert client.execute_command('MGET', *keys) == [None] * 10 + keys[10:]
+    assert client.delete(keys[10]) == 1
+
+    client.hset('split hash', 'field', 'value')
+    assert client.hgetall('split hash') == {'field': 'value'}
+    assert client.ttl('split hash') == -1
+    with pytest.raises(RuntimeError):
+        client.rename(keys[11], keys[12])
+
+
+def test_redis_cluster_client_slot_router(redis_cluster_hosts):
+    cluster = RedisCluster(redis_cluster_hosts,
+                           router_cls=RedisClusterSlotRouter)
+    client = cluster.get_client(max_keys_per_command=3)
+    keys = ['slot-key-%s' % i for i in range(30)]
+    for key in keys:
+        assert client.set(key, key)
+    # keys of different slots never share one command
+    assert client.mget(keys) == keys
+    assert client.execute_command('MGET', *keys) == keys
+    assert client.msetex(dict((key, key + '!') for key in keys), 60)
+    assert client.mget(keys) == [key + '!' for key in keys]
+    assert client.execute_command('EXISTS', *keys)
+    with client.pipeline() as pipe:
+        pipe.incr('{counter}a').incr('{counter}b').get('{counter}a')
+        pipe.mget(['{counter}a', '{counter}b'])
+        assert pipe.execute() == [1, 1, '1', ['1', '1']]
+    assert client.delete(*keys[:10]) == 10
+    assert client.mdelete(*keys[10:]) == 20
+    assert client.mdelete('{counter}a', '{counter}b') == 2
+    assert client.mget(keys) == [None] * 30
+
+
+def test_redis_cluster_client_redirects(redis_cluster_hosts):
+    cluster = RedisCluster(redis_cluster_hosts,
+                           router_cls=RedisClusterSlotRouter)
+    router = cluster.router
+    client = cluster.get_client()
+    node_clients = dict((host_name, StrictRedis(port=host['port']))
+                        for host_name, host in redis_cluster_hosts.items())
+    node_ids = dict((host_name, node_client.execute_command('CLUSTER MYID'))
+                    for host_name, node_client in node_clients.items())
+
+    def get_other_host(key):
+        host_name = router.get_host_for_key(key)
+        return [name for name in sorted(node_ids) if name != host_name][0]
+
+    def move_slot(key, host_name):
+        for node_client in node_clients.values():
+            node_client.execute_command(
+                'CLUSTER SETSLOT', router.get_slot_for_key(key), 'NODE',
+                node_ids[host_name])
+
+    # MOVED for single commands, multi key commands and pipelines, the
+    # router still has the old slot table every time
+    for key in ('moved-a', 'moved-b', 'moved-c'):
+        host_name = get_other_host(key)
+        move_slot(key, host_name)
+        if key == 'moved-a':
+            assert client.set(key, 'a')
+        elif key == 'moved-b':
+            assert client.msetex({key: 'b'}, 60)
+        else:
+            assert client.pipeline().set(key, 'c').execute() == [True]
+        assert router.get_host_for_key(key) == host_name
+        assert node_clients[host_name].get(key) == key[-1]
+    assert client.mget(['moved-a', 'moved-b', 'moved-c']) == ['a', 'b', 'c']
+
+    # ASK while a slot is migrating, the slot table stays the same
+    key = 'asked'
+    source = router.get_host_for_key(key)
+    target = get_other_host(key)
+    slot = router.get_slot_for_key(key)
+    node_clients[target].execute_command('CLUSTER SETSLOT', slot,
+                                         'IMPORTING', node_ids[source])
+    node_clients[source].execute_command('CLUSTER SETSLOT', slot,
+                                         'MIGRATING', node_ids[target])
+    assert client.set(key, 'value')
+    assert client.get(key) == 'value'
+    assert client.mget([key, 'moved-a']) == ['value', 'a']
+    assert client.pipeline().get(key).execute() == ['value']
+    assert router.get_host_for_key(key) == source
+    move_slot(key, target)
+    assert client.get(key) == 'value'
+    assert router.get_host_for_key(key) == target
+
+    with pytest.raises(ResponseError):
+        StrictRedis(port=redis_cluster_hosts[source]['port']).get(key)
+
+
+@pytest.mark.parametrize('max_keys_per_command', [None, 100])
+def test_redis_cluster_client_large_requests(redis_hosts,
+                                             max_keys_per_command):
+    # the requests are larger than the socket buffers, replies arrive
+    # before everything is sent
+    cluster = RedisCluster({0: redis_hosts.values()[0]})
+    client = cluster.get_client(max_keys_per_command=max_keys_per_command)
+    value = 'x' * (1024 * 1024)
+    big_values = dict(('big key: %s' % i, value) for i in xrange(4))
+    assert client.msetex(big_values, 100)
+    keys = ['large request key: %s' % i for i in xrange(50000)]
+    assert client.mget(keys) == [None] * len(keys)
+    assert client.mget(big_values.keys()) == [value] * 4
+    assert client.mdelete(*big_values) == 4
+
+
+def test_redis_cluster_client_large_pipeline(redis_hosts):
+    cluster = RedisCluster({0: redis_hosts.values()[0]})
+    client = cluster.get_client()
+    with client.pipeline() as pipe:
+        for i in xrange(20000):
+            pipe.incr('large pipeline key')
+        assert pipe.execute()[-1] == 20000
+    assert client.delete('large pipeline key') == 1
@@ -1,6 +1,15 @@
 import pytest
+from redis import StrictRedis
 
 from rc.redis_cluster import RedisCluster
+from rc.redis_router import RedisCRC32HashRouter, RedisConsistentHashRouter
+from rc.redis_router import RedisJumpHashRouter, RedisRendezvousHashRouter
+from rc.redis_router import RedisClusterSlotRouter
+from rc.redis_router import jump_hash, extract_hash_tag, crc16, key_hash_slot
+
+
+all_router_classes = [RedisCRC32HashRouter, RedisConsistentHashRouter,
+                      RedisJumpHashRouter, RedisRendezvousHashRouter]
 
 
 def test_redis_router_basics():
@@ -23,3 +32,154 @@ def test_redis_router_basics():
     assert router.get_host_for_command('GET', 'c') == 0
     assert router.get_host_for_command('GET', 'g') == 1
     assert router.get_host_for_command('SET', 'a') == 2
+
+
+def test_redis_router_key_specs():
+    cluster = RedisCluster({
+        0: {},
+        1: {},
+        2: {},
+    })
+    router = cluster.router
+
+    assert router.get_key_spec('HGET') == (0, 0, 1)
+    assert router.get_key_spec('zadd') == (0, 0, 1)
+    with pytest.raises(RuntimeError):
+        router.get_key_spec('ZUNIONSTORE')
+
+    assert router.get_keys_for_command('INCR', ('c',)) == ('c',)
+    assert router.get_keys_for_command('MGET', ('a', 'b')) == ('a', 'b')
+    assert router.get_keys_for_command('MSET', ('a', 1, 'b', 2)) == ('a', 'b')
+    assert router.get_keys_for_command('BLPOP', ('a', 'b', 0)) == ('a', 'b')
+    assert router.get_keys_for_command('BITOP', ('AND', 'a', 'b')) == \
+        ('a', 'b')
+    assert router.get_key_for_command('HSET', ('g', 'field', 1)) == 'g'
+    with pytest.raises(RuntimeError):
+        router.get_key_for_command('RENAME', ('c', 'g'))
+
+    assert router.get_host_for_command('EXPIRE', ('g', 10)) == 1
+    assert router.get_host_for_command('RENAME', ('c', 'c2')) == 0
+    with pytest.raises(RuntimeError):
+        router.get_host_for_command('RENAME', ('c', 'g'))
+
+
+@pytest.mark.parametrize('router_cls', all_router_classes)
+@pytest.mark.parametrize('memo_size', [0, 10])
+def test_redis_router_get_hosts_for_keys(router_cls, memo_size):
+    cluster = RedisCluster(dict((i, {}) for i in range(8)),
+                           router_cls=router_cls,
+                           router_options={'memo_size': memo_size})
+    router = cluster.router
+    keys = ['key %s' % i for i in range(100)] + [u'k\xe9y', 'key 0']
+    host_keys = router.get_hosts_for_keys(keys)
+    assert sorted(k for ks in host_keys.values() for k in ks) == sorted(keys)
+    for host_name, keys_of_host in host_keys.iteritems():
+        for key in keys_of_host:
+            assert router.get_host_for_key(key) == host_name
+    assert router.get_hosts_for_keys(keys) == host_keys
+    assert len(router._memo) <= memo_size
+
+
+@pytest.mark.parametrize('router_cls', all_router_classes)
+def test_redis_router_add_and_remove_hosts(router_cls):
+    cluster = RedisCluster(dict((i, {'port': 6379 + i}) for i in range(4)),
+                           router_cls=router_cls,
+                           router_options={'memo_size': 100})
+    router = cluster.router
+    keys = ['key %s' % i for i in range(1000)]
+    before = [router.get_host_for_key(key) for key in keys]
+    router.get_hosts_for_keys(keys)
+    cluster.add_host(4, port=6383)
+    assert 4 in cluster.hosts
+    after = [router.get_host_for_key(key) for key in keys]
+    assert router.get_hosts_for_keys(keys) == \
+        router_cls(cluster.hosts).get_hosts_for_keys(keys)
+    if router_cls is not RedisCRC32HashRouter:
+        for old_host, new_host in zip(before, after):
+            assert new_host in (old_host, 4)
+    cluster.get_pool_of_host(4)
+    cluster.remove_host(4)
+    assert 4 not in cluster.hosts
+    assert 4 not in cluster._pools
+    assert [router.get_host_for_key(key) for key in keys] == before
+
+
+@pytest.mark.parametrize('router_cls', [RedisConsistentHashRouter,
+                                        RedisRendezvousHashRouter])
+def test_redis_router_weights(router_cls):
+    cluster = RedisCluster({
+        0: {'port': 6379},
+        1: {'port': 6380, 'weight': 3},
+    }, router_cls=router_cls)
+    host_keys = cluster.router.get_hosts_for_keys(
+        ['key %s' % i for i in range(1000)])
+    assert len(host_keys[1]) > 2 * len(host_keys[0])
+
+
+def test_jump_hash():
+    keys = range(0, 1 << 40, 1 << 27)
+    for bucket_count in range(1, 20):
+        for key in keys:
+            bucket = jump_hash(key, bucket_count)
+            assert 0 <= bucket < bucket_count
+            assert jump_hash(key, bucket_count + 1) in (bucket, bucket_count)
+
+
+@pytest.mark.parametrize('router_cls', all_router_classes)
+def test_redis_router_hash_tags(router_cls):
+    hosts = dict((i, {'port': 6379 + i}) for i in range(8))
+    router = RedisCluster(hosts, router_cls=router_cls,
+                          router_options={'hash_tags': True}).router
+    keys = ['{user:42}:%s' % i for i in range(50)] + \
+        [u'profile {user:42}', 'user:42']
+    host_keys = router.get_hosts_for_keys(keys)
+    assert host_keys.keys() == [router.get_host_for_key('user:42')]
+    assert router.get_host_for_command('MGET', keys) == host_keys.keys()[0]
+
+    assert extract_hash_tag('{a}b{c}') == 'a'
+    assert extract_hash_tag('a{}b{c}') == 'a{}b{c}'
+    assert extract_hash_tag('{a') == '{a'
+    assert extract_hash_tag(u'x{\xe9}') == u'\xe9'
+    assert extract_hash_tag(42) == 42
+
+    router = RedisCluster(hosts, router_cls=router_cls).router
+    assert len(router.get_hosts_for_keys(keys)) > 1
+
+
+def test_key_hash_slot():
+    assert crc16('123456789') == 0x31c3
+    assert key_hash_slot('foo') == 12182
+    assert key_hash_slot(u'foo') == 12182
+    assert key_hash_slot('{user1000}.following') == \
+        key_hash_slot('{user1000}.followers') == key_hash_slot('user1000')
+    assert key_hash_slot('foo{}{bar}') == crc16('foo{}{bar}') % 16384
+    assert key_hash_slot(42) == key_hash_slot('42')
+    with pytest.raises(RuntimeError):
+        RedisClusterSlotRouter({}, hash_tags=False)
+
+
+@pytest.mark.parametrize('memo_size', [0, 10])
+def test_redis_cluster_slot_router(redis_cluster_hosts, memo_size):
+    seed_host_name = sorted(redis_cluster_hosts)[0]
+    cluster = RedisCluster(
+        {seed_host_name: redis_cluster_hosts[seed_host_name]},
+        router_cls=RedisClusterSlotRouter,
+        router_options={'memo_size': memo_size})
+    router = cluster.router
+    keys = ['key-%s' % i for i in range(100)]
+    host_keys = router.get_hosts_for_keys(keys)
+
+    # the other nodes are found in the slot table
+    assert sorted(host_config.port for host_config in
+                  cluster.hosts.values()) == \
+        sorted(host['port'] for host in redis_cluster_hosts.values())
+    assert seed_host_name in host_keys
+    assert len(host_keys) == 3
+    for host_name, keys_of_host in host_keys.items():
+        client = StrictRedis(port=cluster.hosts[host_name].port)
+        for key in keys_of_host:
+            assert router.get_host_for_key(key) == host_name
+            assert client.execute_command('CLUSTER KEYSLOT', key) == \
+                router.get_slot_for_key(key)
+            # only the node of the slot answers without MOVED
+            assert client.get(key) is None
@@ -1,4 +1,8 @@
+import pytest
+
+from rc import serializer as serializer_module
 from rc.serializer import PickleSerializer, JSONSerializer
+from rc.serializer import MsgpackSerializer, MarshalSerializer
 
 
 def test_pickle_serializer():
@@ -27,3 +31,43 @@ def test_json_serializer():
     string = serializer.dumps(obj)
     assert obj == serializer.loads(string)
     assert serializer.loads(None) is None
+
+
+@pytest.mark.parametrize('serializer', [PickleSerializer(2),
+                                        MsgpackSerializer(),
+                                        MarshalSerializer()])
+def test_binary_serializers(serializer):
+    for obj in [1, -2, -15, u'test', 1.5, None, True, [1, u'2'],
+                {u'key': u'value'}]:
+        string = serializer.dumps(obj)
+        assert obj == serializer.loads(string)
+    assert serializer.loads(None) is None
+
+
+def test_msgpack_serializer_without_msgpack(monkeypatch):
+    monkeypatch.setattr(serializer_module, 'msgpack', None)
+    with pytest.raises(RuntimeError):
+        MsgpackSerializer()
+
+
+@pytest.mark.parametrize('serializer', [PickleSerializer(),
+                                        JSONSerializer(),
+                                        MsgpackSerializer(),
+                                        MarshalSerializer()])
+def test_serializer_many(serializer):
+    objs = [1, u'test', {u'key': u'value'}, [1, 2], None]
+    strings = serializer.dumps_many(objs)
+    assert strings == [serializer.dumps(obj) for obj in objs]
+    assert serializer.loads_many(strings) == objs
+    assert serializer.loads_many(strings[:2] + [None] + strings[2:]) == \
+        objs[:2] + [None] + objs[2:]
+    assert serializer.dumps_many([]) == []
+    assert serializer.loads_many([]) == []
+    assert serializer.loads_many([None]) == [None]
+
+
+def test_msgpack_serializer_loads_many_bad_string():
+    serializer = MsgpackSerializer()
+    with pytest.raises(Exception):
+        serializer.loads_many([serializer.dumps(1), '"x"',
+                               serializer.dumps(u'hello')])
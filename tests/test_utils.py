@@ -1,4 +1,7 @@
-from rc.utils import generate_key_for_cached_func
+import pytest
+
+from rc.utils import generate_key_for_cached_func, pack_meta, unpack_meta
+from rc.utils import make_arg_getter
 
 
 def test_generate_key():
@@ -25,3 +28,25 @@ def test_generate_key():
         pass
     cache_key = generate_key_for_cached_func(None, method, 'foo')
     assert cache_key == u'test_utils method foo'
+
+
+def test_meta():
+    string = pack_meta('value', 0.5, 100.0)
+    assert unpack_meta(string) == ('value', 0.5, 100.0)
+    assert unpack_meta('value') == ('value', None, None)
+    assert unpack_meta(None) == (None, None, None)
+
+
+def test_make_arg_getter():
+    def func(self, a, b=2, *args):
+        pass
+    getter = make_arg_getter(func, 1, has_self=True)
+    assert getter(1, 3) == 3
+    assert getter(1, b=3) == 3
+    assert getter(1) == 2
+    assert make_arg_getter(func, 0)('self', 1) == 'self'
+    assert make_arg_getter(func, 3)(0, 1, 2, 3) == 3
+    with pytest.raises(TypeError):
+        make_arg_getter(func, 0, has_self=True)()
+    with pytest.raises(TypeError):
+        make_arg_getter(func, 3)(0, 1, 2)